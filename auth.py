@@ -1,9 +1,11 @@
 # auth.py
 from fastapi import FastAPI, Depends, HTTPException
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
-from sqlmodel import Session, select
-from database import get_db
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from database import get_async_db
 from models import User
+import asyncio
 import bcrypt
 
 security = HTTPBasic()
@@ -20,14 +22,12 @@ def verify_password(plain_password: str, hashed_password: str) -> bool:
 
 async def get_current_user(
     credentials: HTTPBasicCredentials = Depends(security),
-    db: Session = Depends(get_db)
+    session: AsyncSession = Depends(get_async_db)
 ) -> User:
     """Получаем текущего пользователя по email и паролю"""
-    session = next(db)
-    
-    user = session.exec(
+    user = (await session.exec(
         select(User).where(User.email == credentials.username) 
-    ).first()
+    )).first()
 
     if not user:
         raise HTTPException(
@@ -36,8 +36,8 @@ async def get_current_user(
             headers={"WWW-Authenticate": "Basic"},
         )
     
-    # Проверяем пароль
-    if not verify_password(credentials.password, user.password): 
+    # Проверяем пароль (bcrypt медленный — считаем вне event loop)
+    if not await asyncio.to_thread(verify_password, credentials.password, user.password): 
         raise HTTPException(
             status_code=401,
             detail="Неверный email или пароль",
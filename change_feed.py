@@ -0,0 +1,112 @@
+import base64
+import json
+import os
+from datetime import datetime, timedelta
+from sqlalchemy import insert, delete, select, func
+from models import User, Task, ChangeFeed
+from company_revision import company_ids_of, EPOCH_COMPANY_ID, REVISION_TABLE
+
+# Сколько дней хранится лента изменений; более старый курсор получает 410
+CHANGE_FEED_RETENTION_DAYS = int(os.getenv("CHANGE_FEED_RETENTION_DAYS", "7"))
+# Как часто чистить ленту (часы)
+CHANGE_FEED_PRUNE_INTERVAL_HOURS = float(os.getenv("CHANGE_FEED_PRUNE_INTERVAL_HOURS", "6"))
+
+# Таблицы, изменения которых попадают в ленту
+FEED_TABLES = {User: "user", Task: "task"}
+
+FEED_TABLE = ChangeFeed.__table__
+
+
+def record_changes(connection, table_name: str, rows):
+    """Добавляем в ленту измененные записи: rows — пары (id записи, id компании)"""
+    now = datetime.utcnow()
+    values = [
+        {"company_id": company_id, "table_name": table_name, "record_id": record_id, "changed_at": now}
+        for record_id, company_id in rows if company_id is not None
+    ]
+    if values:
+        connection.execute(insert(FEED_TABLE), values)
+
+
+def record_flushed(session, flush_context):
+    """Хук after_flush: изменения через ORM попадают в ленту в той же транзакции (регистрируется в outbox)"""
+    changed = list(session.new) + list(session.deleted) + [
+        obj for obj in session.dirty if session.is_modified(obj, include_collections=False)
+    ]
+    rows = {}
+    for obj in changed:
+        table_name = FEED_TABLES.get(type(obj))
+        if table_name is None:
+            continue
+        # Запись, перешедшая в другую компанию, попадает и в ленту прежней компании (как удаленная)
+        for company_id in company_ids_of(obj):
+            rows.setdefault(table_name, []).append((obj.id, company_id))
+    for table_name, pairs in rows.items():
+        record_changes(session.connection(), table_name, pairs)
+
+
+class ChangeFeedPruner:
+    """Удаление записей ленты старше срока хранения"""
+
+    def __init__(self):
+        self._last_run = None
+
+    def prune_if_due(self, writers):
+        now = datetime.utcnow()
+        if self._last_run and now - self._last_run < timedelta(hours=CHANGE_FEED_PRUNE_INTERVAL_HOURS):
+            return
+        self._last_run = now
+        removed = 0
+        try:
+            for writer in writers:
+                removed += writer.run(lambda local_session: self._prune(local_session, now), skip_outbox=True)
+        except Exception as e:
+            print(f"❌ Error pruning change feed: {e}")
+        if removed:
+            print(f"🧹 Pruned {removed} change feed entries older than {CHANGE_FEED_RETENTION_DAYS} days")
+
+    @staticmethod
+    def _prune(local_session, now: datetime) -> int:
+        # Последнюю запись оставляем: по ней видно, что курсор из удаленной части ленты
+        return local_session.execute(
+            delete(FEED_TABLE)
+            .where(FEED_TABLE.c.changed_at < now - timedelta(days=CHANGE_FEED_RETENTION_DAYS))
+            .where(FEED_TABLE.c.id < select(func.max(FEED_TABLE.c.id)).scalar_subquery())
+        ).rowcount
+
+
+def encode_feed_cursor(positions: list) -> str:
+    """Курсор ленты: [эпоха файла, позиция] для каждого файла базы компании"""
+    raw = json.dumps(positions).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_feed_cursor(cursor: str) -> list:
+    """Позиции из курсора ленты; ValueError — курсор поврежден"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        return [(int(epoch), int(position)) for epoch, position in json.loads(raw)]
+    except Exception as e:
+        raise ValueError("Некорректный курсор ленты изменений") from e
+
+
+async def feed_state(session) -> tuple:
+    """Эпоха файла базы и границы ленты (min id, max id)"""
+    epoch = (await session.execute(
+        select(REVISION_TABLE.c.revision).where(REVISION_TABLE.c.company_id == EPOCH_COMPANY_ID)
+    )).scalar() or 0
+    lowest, highest = (await session.execute(select(func.min(FEED_TABLE.c.id), func.max(FEED_TABLE.c.id)))).one()
+    return epoch, lowest, highest
+
+
+async def read_feed(session, company_id: int, position: int, tables: tuple, limit: int) -> tuple:
+    """Записи ленты компании после позиции: ([(id, таблица, id записи)], есть ли еще)"""
+    entries = (await session.execute(
+        select(FEED_TABLE.c.id, FEED_TABLE.c.table_name, FEED_TABLE.c.record_id)
+        .where(FEED_TABLE.c.company_id == company_id)
+        .where(FEED_TABLE.c.id > position)
+        .where(FEED_TABLE.c.table_name.in_(tables))
+        .order_by(FEED_TABLE.c.id)
+        .limit(limit + 1)
+    )).all()
+    return entries[:limit], len(entries) > limit
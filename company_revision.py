@@ -0,0 +1,75 @@
+import time
+from sqlalchemy import event, inspect, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+from models import Company, User, Task, TaskArchive, CompanyRevision
+
+# Таблицы, изменения которых меняют списки компании
+REVISION_MODELS = (Company, User, Task, TaskArchive)
+
+# Строка эпохи: ETag не совпадет с выданным до пересоздания файла базы
+EPOCH_COMPANY_ID = 0
+
+REVISION_TABLE = CompanyRevision.__table__
+
+
+def company_ids_of(obj) -> set:
+    """Компании, списки которых затрагивает изменение записи (с учетом смены company_id)"""
+    if isinstance(obj, Company):
+        return {obj.id}
+    state = inspect(obj)
+    ids = {obj.company_id}
+    if "company_id" in state.attrs:
+        ids.update(state.attrs.company_id.history.deleted or ())
+    return ids
+
+
+def bump(connection, company_ids):
+    """Увеличиваем счетчики изменений компаний (в транзакции вызывающего)"""
+    ids = sorted({company_id for company_id in company_ids if company_id is not None})
+    if not ids:
+        return
+    stmt = sqlite_insert(REVISION_TABLE).values([{"company_id": company_id, "revision": 1} for company_id in ids])
+    connection.execute(stmt.on_conflict_do_update(
+        index_elements=[REVISION_TABLE.c.company_id],
+        set_={"revision": REVISION_TABLE.c.revision + 1}
+    ))
+
+
+def create_epoch(connection):
+    """Эпоха файла базы: время создания в миллисекундах"""
+    connection.execute(
+        sqlite_insert(REVISION_TABLE)
+        .values(company_id=EPOCH_COMPANY_ID, revision=int(time.time() * 1000))
+        .on_conflict_do_nothing()
+    )
+
+
+@event.listens_for(Session, "after_flush")
+def _bump_changed(session, flush_context):
+    """Изменения через ORM (API, поток записи, получение из Supabase) — в той же транзакции"""
+    changed = list(session.new) + list(session.deleted) + [
+        obj for obj in session.dirty if session.is_modified(obj, include_collections=False)
+    ]
+    company_ids = set()
+    for obj in changed:
+        if isinstance(obj, REVISION_MODELS):
+            company_ids |= company_ids_of(obj)
+    bump(session.connection(), company_ids)
+
+
+async def read_etag(session, company_id: int, *parts) -> str:
+    """Слабый ETag списка компании по счетчику изменений — без чтения самих записей"""
+    revisions = dict((await session.execute(
+        select(REVISION_TABLE.c.company_id, REVISION_TABLE.c.revision)
+        .where(REVISION_TABLE.c.company_id.in_((EPOCH_COMPANY_ID, company_id)))
+    )).all())
+    tag = ".".join(str(part) for part in (company_id, revisions.get(EPOCH_COMPANY_ID, 0), revisions.get(company_id, 0), *parts))
+    return f'W/"{tag}"'
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    tags = {tag.strip() for tag in if_none_match.split(",")}
+    return "*" in tags or etag in tags or etag.removeprefix("W/") in tags
@@ -1,71 +1,412 @@
-from sqlmodel import SQLModel, create_engine, Session
-from typing import Generator
+from sqlmodel import create_engine, Session
+from typing import Generator, AsyncGenerator
 import os
+import asyncio
+import glob
+import re
+import threading
 from dotenv import load_dotenv
-from sqlalchemy import text
+from sqlalchemy import text, event, select
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlmodel.ext.asyncio.session import AsyncSession
+from outbox import SKIP_OUTBOX
+from migrations import migrate
+from models import Task, TaskHistory, TaskArchive, SyncOutbox
+from local_writer import LocalWriteCoordinator
 
 load_dotenv()
 
+LOCAL_DB_PATH = "./task_manager.db"
+
+# Шардирование: задачи каждой компании (с историей, архивом и outbox задач) хранятся
+# в отдельном файле SQLite. Компании, пользователи и служебные таблицы остаются в основной базе
+LOCAL_SHARDING = os.getenv("LOCAL_SHARDING", "false").lower() in ("1", "true", "yes")
+LOCAL_SHARD_DIR = os.getenv("LOCAL_SHARD_DIR", "./shards")
+
+# Профили настроек движков, выбираются через DB_PROFILE.
+# Любой параметр можно переопределить переменной окружения SQLITE_<ПАРАМЕТР> / PG_<ПАРАМЕТР>,
+# например SQLITE_MMAP_SIZE=0 или PG_POOL_SIZE=10
+ENGINE_PROFILES = {
+    # Настольное приложение: один пользователь, немного соединений
+    "desktop": {
+        "sqlite": {
+            "journal_mode": "WAL", # Читатели не блокируются записью синхронизации
+            "synchronous": "NORMAL", # В WAL безопасно и без fsync на каждый коммит
+            "mmap_size": 64 * 1024 * 1024,
+            "cache_size": -16000, # В КиБ (отрицательное значение), ~16 МБ
+            "busy_timeout": 5000, # мс ожидания блокировки вместо "database is locked"
+        },
+        "postgres": {
+            "pool_size": 2,
+            "max_overflow": 2,
+            "pool_timeout": 10,
+            "pool_pre_ping": True, # Отбрасываем соединения, разорванные за время простоя
+            "pool_recycle": 300, # Пересоздаем соединения раньше, чем их закроет пулер Supabase
+            "connect_timeout": 10,
+            "keepalives_idle": 30,
+            "keepalives_interval": 10,
+            "keepalives_count": 3,
+            "statement_timeout": 60000, # мс, 0 — без ограничения
+        },
+    },
+    # Сервер: много одновременных запросов
+    "server": {
+        "sqlite": {
+            "journal_mode": "WAL",
+            "synchronous": "NORMAL",
+            "mmap_size": 256 * 1024 * 1024,
+            "cache_size": -64000,
+            "busy_timeout": 10000,
+        },
+        "postgres": {
+            "pool_size": 10,
+            "max_overflow": 20,
+            "pool_timeout": 30,
+            "pool_pre_ping": True,
+            "pool_recycle": 300,
+            "connect_timeout": 10,
+            "keepalives_idle": 30,
+            "keepalives_interval": 10,
+            "keepalives_count": 3,
+            "statement_timeout": 60000,
+        },
+    },
+}
+
+
+def get_engine_profile(kind: str) -> dict:
+    """Настройки движка kind ("sqlite" / "postgres") из профиля DB_PROFILE с учетом переменных окружения"""
+    profile_name = os.getenv("DB_PROFILE", "desktop")
+    if profile_name not in ENGINE_PROFILES:
+        print(f"⚠️ Неизвестный профиль DB_PROFILE={profile_name}, используется desktop")
+        profile_name = "desktop"
+
+    prefix = "SQLITE_" if kind == "sqlite" else "PG_"
+    profile = dict(ENGINE_PROFILES[profile_name][kind])
+    for key, default in profile.items():
+        value = os.getenv(prefix + key.upper())
+        if value is None:
+            continue
+        if isinstance(default, bool):
+            profile[key] = value.lower() in ("1", "true", "yes")
+        elif isinstance(default, int):
+            profile[key] = int(value)
+        else:
+            profile[key] = value
+    return profile
+
 
 class SafeDatabaseManager:
     def __init__(self):
-        self.local_engine = None # Движок для локальной базы
+        self.local_engine = None # Движок для локальной базы (синхронизация, миграции)
+        self.local_async_engine = None # Асинхронный движок для локальной базы (обработчики API)
         self.remote_engine = None # Движок для удаленной базы
         self.is_online = False # Есть интернет?
-        
+        self.remote_schema_ready = False # Таблицы в Supabase созданы
+        self.remote_checked = False # Подключение к Supabase уже проверялось
+        self.local_ready = False # Локальная база готова обслуживать запросы
+        self.shards = {} # company_id -> (движок, асинхронный движок) файла компании
+        self.unsharded_companies = set() # Компании, задачи которых не удалось перенести: остаются в основной базе
+        self._shards_lock = threading.Lock()
+        self.writers = {} # движок -> поток записи в этот файл
+
     def init_databases(self):
-        self.local_engine = create_engine("sqlite:///./task_manager.db", echo=False, connect_args={"check_same_thread": False}) # Создание движка для локальной базы
+        """Поднимает только локальную базу. Подключение к Supabase проверяется
+        в фоне через probe_remote, чтобы медленная сеть не задерживала запуск API"""
+        self.local_engine = self._create_local_engine(f"sqlite:///{LOCAL_DB_PATH}") # Создание движка для локальной базы
+        self.local_async_engine = self._create_local_async_engine(f"sqlite+aiosqlite:///{LOCAL_DB_PATH}")
 
-        self.remote_engine = self._create_safe_remote_engine() # Создание движка для удаленной базы через функцию
-        
-        SQLModel.metadata.create_all(self.local_engine) # Создание всех таблиц в базу данных\
+        migrate(self.local_engine) # Создание таблиц и индексов по версиям схемы
+        self.writers[self.local_engine] = LocalWriteCoordinator(
+            self._create_writer_engine(f"sqlite:///{LOCAL_DB_PATH}"), "local-writer"
+        )
 
-        if self.is_online:
-            print("✅ Подключение к Supabase установлено!")
-            self._create_supabase_tables()
-        else:
-            print("📡 Работаем в оффлайн режиме")
-        
+        if LOCAL_SHARDING:
+            os.makedirs(LOCAL_SHARD_DIR, exist_ok=True)
+            # Сначала перенос: файлы компаний, чьи задачи остались в основной базе, не подключаются
+            self._move_tasks_to_shards()
+            for path in glob.glob(os.path.join(LOCAL_SHARD_DIR, "company_*.db")):
+                match = re.search(r"company_(\d+)\.db$", path)
+                if match and int(match.group(1)) not in self.unsharded_companies:
+                    self._get_shard(int(match.group(1)))
+            print(f"🗂️ Локальные задачи разделены по компаниям: {len(self.shards)} файлов")
+        self.local_ready = True
+
+    @property
+    def remote_ready(self) -> bool:
+        """Supabase доступен и схема в нем актуальна — можно синхронизироваться"""
+        return self.is_online and self.remote_schema_ready
+
+    @property
+    def remote_state(self) -> str:
+        if not self.remote_checked:
+            return "connecting"
+        if not self.is_online:
+            return "offline"
+        if not self.remote_schema_ready:
+            return "migrating"
+        return "online"
 
     def _create_supabase_tables(self):
         if not self.remote_engine or not self.is_online:
             return
         try:
-            print("🔄 Создаем таблицы в Supabase...")
-            SQLModel.metadata.create_all(self.remote_engine)
-            print("✅ Таблицы созданы в Supabase!")
+            # Если версия схемы в Supabase совпадает, DDL не выполняется вовсе
+            migrate(self.remote_engine, remote=True)
+            self.remote_schema_ready = True
+            print("✅ Схема Supabase актуальна!")
 
         except Exception as e:
             print(f"❌ Ошибка создания таблиц в Supabase: {e}")
 
-    
-    def _create_safe_remote_engine(self):
-        try:
-            USER = os.getenv("user")
-            PASSWORD = os.getenv("password")
-            HOST = os.getenv("host")
-            PORT = os.getenv("port")
-            DBNAME = os.getenv("dbname")
-            DATABASE_URL = f"postgresql+psycopg2://{USER}:{PASSWORD}@{HOST}:{PORT}/{DBNAME}?sslmode=require"
+    def _create_local_engine(self, url: str):
+        profile = get_engine_profile("sqlite")
+        engine = create_engine(
+            url,
+            echo=False,
+            connect_args={"check_same_thread": False, "timeout": profile["busy_timeout"] / 1000}
+        )
+        self._set_sqlite_pragmas(engine, profile)
+        return engine
 
-            engine = create_engine(DATABASE_URL, echo=False)
+    def _create_local_async_engine(self, url: str):
+        profile = get_engine_profile("sqlite")
+        engine = create_async_engine(
+            url,
+            echo=False,
+            connect_args={"timeout": profile["busy_timeout"] / 1000}
+        )
+        # События соединений вешаются на синхронный движок внутри асинхронного
+        self._set_sqlite_pragmas(engine.sync_engine, profile)
+        return engine
 
-            with Session(engine) as session:
-                session.execute(text("SELECT 1"))
-                print ("✅ Подключение к Supabase успешно!")
+    def _create_writer_engine(self, url: str):
+        """Движок для потока записи: транзакции с явным BEGIN IMMEDIATE"""
+        engine = self._create_local_engine(url)
+
+        # pysqlite не открывает транзакцию перед SAVEPOINT, и RELEASE сразу фиксирует изменения.
+        # Поэтому транзакцией управляем сами; IMMEDIATE берет блокировку записи в начале (ожидание — busy_timeout)
+        @event.listens_for(engine, "connect")
+        def _disable_driver_transactions(dbapi_connection, connection_record):
+            dbapi_connection.isolation_level = None
+
+        @event.listens_for(engine, "begin")
+        def _begin_immediate(connection):
+            connection.exec_driver_sql("BEGIN IMMEDIATE")
+
+        return engine
 
+    def _set_sqlite_pragmas(self, engine, profile: dict):
+        @event.listens_for(engine, "connect")
+        def _set_sqlite_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            cursor.execute(f"PRAGMA journal_mode={profile['journal_mode']}")
+            cursor.execute(f"PRAGMA synchronous={profile['synchronous']}")
+            cursor.execute(f"PRAGMA mmap_size={profile['mmap_size']}")
+            cursor.execute(f"PRAGMA cache_size={profile['cache_size']}")
+            cursor.execute(f"PRAGMA busy_timeout={profile['busy_timeout']}")
+            cursor.close()
+
+    def _build_remote_engine(self):
+        USER = os.getenv("user")
+        PASSWORD = os.getenv("password")
+        HOST = os.getenv("host")
+        PORT = os.getenv("port")
+        DBNAME = os.getenv("dbname")
+        DATABASE_URL = f"postgresql+psycopg2://{USER}:{PASSWORD}@{HOST}:{PORT}/{DBNAME}?sslmode=require"
+
+        profile = get_engine_profile("postgres")
+        connect_args = {
+            "connect_timeout": profile["connect_timeout"],
+            "keepalives": 1,
+            "keepalives_idle": profile["keepalives_idle"],
+            "keepalives_interval": profile["keepalives_interval"],
+            "keepalives_count": profile["keepalives_count"],
+        }
+        if profile["statement_timeout"]:
+            connect_args["options"] = f"-c statement_timeout={profile['statement_timeout']}"
+
+        return create_engine(
+            DATABASE_URL,
+            echo=False,
+            pool_size=profile["pool_size"],
+            max_overflow=profile["max_overflow"],
+            pool_timeout=profile["pool_timeout"],
+            pool_pre_ping=profile["pool_pre_ping"],
+            pool_recycle=profile["pool_recycle"],
+            connect_args=connect_args
+        )
+
+    def probe_remote(self) -> bool:
+        """Проверка подключения к Supabase (первая — при запуске), переключает is_online в обе стороны.
+        Блокирующая: вызывается из фонового потока"""
+        was_online = self.is_online
+        first_check = not self.remote_checked
+        try:
+            if self.remote_engine is None:
+                self.remote_engine = self._build_remote_engine()
+            with Session(self.remote_engine) as session:
+                session.execute(text("SELECT 1"))
             self.is_online = True
-            return engine
         except Exception as e:
-            print(f"Supabase connection failed: {e}")
-            print("Подключение к Supabase с ошибкой!!!")
+            if was_online:
+                print(f"📡 Supabase недоступен, переходим в оффлайн режим: {e}")
+            elif first_check:
+                print(f"📡 Работаем в оффлайн режиме: {e}")
             self.is_online = False
-            return None
-        
+
+        if self.is_online and not was_online:
+            print("✅ Подключение к Supabase установлено!" if first_check else "✅ Подключение к Supabase восстановлено!")
+        if self.is_online and not self.remote_schema_ready:
+            # Повторяем и после неудачной миграции
+            self._create_supabase_tables()
+        self.remote_checked = True
+        return self.is_online
+
     def get_session(self) -> Generator[Session, None, None]:
         with Session(self.local_engine) as session:
             yield session
+
+    async def get_async_session(self) -> AsyncGenerator[AsyncSession, None]:
+        # expire_on_commit=False: после commit объекты отдаются в ответ без ленивой догрузки
+        async with AsyncSession(self.local_async_engine, expire_on_commit=False) as session:
+            yield session
     
+    def get_sync_session(self, engine=None) -> Session:
+        # Изменения, пришедшие из Supabase, не должны попадать в outbox
+        return Session(engine or self.local_engine, info={SKIP_OUTBOX: True})
+
+    def _get_shard(self, company_id: int):
+        """(движок, асинхронный движок) файла компании; файл создается при первом обращении"""
+        shard = self.shards.get(company_id)
+        if shard:
+            return shard
+        with self._shards_lock:
+            shard = self.shards.get(company_id)
+            if not shard:
+                path = self._shard_path(company_id)
+                engine = self._create_local_engine(f"sqlite:///{path}")
+                migrate(engine)
+                self.writers[engine] = LocalWriteCoordinator(
+                    self._create_writer_engine(f"sqlite:///{path}"), f"local-writer-{company_id}"
+                )
+                shard = (engine, self._create_local_async_engine(f"sqlite+aiosqlite:///{path}"))
+                self.shards[company_id] = shard
+        return shard
+
+    def company_engine(self, company_id):
+        """Движок, в котором хранятся задачи компании"""
+        if not LOCAL_SHARDING or company_id is None or company_id in self.unsharded_companies:
+            return self.local_engine
+        return self._get_shard(company_id)[0]
+
+    def task_engines(self) -> list:
+        """Все движки с задачами: основная база (в режиме шардов — задачи без компании и неперенесенных компаний) и файлы компаний"""
+        return [self.local_engine] + [engine for engine, _ in list(self.shards.values())]
+
+    def get_writer(self, engine=None) -> LocalWriteCoordinator:
+        """Поток записи файла SQLite (по умолчанию — основной базы)"""
+        return self.writers[engine or self.local_engine]
+
+    def get_company_writer(self, company_id) -> LocalWriteCoordinator:
+        """Поток записи файла, в котором хранятся задачи компании"""
+        return self.get_writer(self.company_engine(company_id))
+
+    def get_company_async_session(self, company_id, create: bool = True) -> AsyncSession:
+        """Асинхронная сессия для задач компании (используется как async with)
+
+        create=False — для чтения: файл компании не создается, а если его нет, запрос
+        уходит в основную базу, где задач этой компании нет
+        """
+        engine = self.local_async_engine
+        if LOCAL_SHARDING and company_id is not None and company_id not in self.unsharded_companies \
+                and (create or company_id in self.shards):
+            engine = self._get_shard(company_id)[1]
+        return AsyncSession(engine, expire_on_commit=False)
+
+    def _shard_path(self, company_id: int) -> str:
+        return os.path.join(LOCAL_SHARD_DIR, f"company_{company_id}.db")
+
+    def _move_tasks_to_shards(self):
+        """Перенос задач из основной базы в файлы компаний при включении шардирования
+
+        Переносятся задачи, их история, архив и записи outbox задач. Перенос повторяемый:
+        если он прервался, при следующем запуске копия в файле компании перезаписывается.
+        Пока задачи компании остаются в основной базе, ее файл не используется —
+        задачи обслуживаются и синхронизируются из основной базы
+        """
+        task, archive = Task.__table__, TaskArchive.__table__
+        with self.local_engine.connect() as main:
+            company_ids = set(main.execute(select(task.c.company_id).where(task.c.company_id != None).distinct()).scalars())
+            company_ids |= set(main.execute(select(archive.c.company_id).where(archive.c.company_id != None).distinct()).scalars())
+
+        for company_id in sorted(company_ids):
+            try:
+                moved, archived = self._move_company_tasks(company_id)
+                print(f"🗂️ Задачи компании {company_id} перенесены в отдельный файл: {moved} + {archived} в архиве")
+            except Exception as e:
+                self.unsharded_companies.add(company_id)
+                print(f"❌ Ошибка переноса задач компании {company_id}, они остаются в основной базе: {e}")
+
+    def _move_company_tasks(self, company_id: int):
+        """Перенос задач одной компании; возвращает (задач, архивных задач)
+
+        Файл компании подключается к основной базе (ATTACH), строки выбираются по company_id
+        подзапросами. Сначала фиксируется копия в файле компании, затем удаление из основной базы
+        """
+        path = self._shard_path(company_id)
+        shard_engine = self._create_local_engine(f"sqlite:///{path}")
+        try:
+            migrate(shard_engine)
+        finally:
+            shard_engine.dispose()
+
+        def columns(table, with_id: bool = True) -> str:
+            return ", ".join(f'"{column.name}"' for column in table.columns if with_id or column.name != "id")
+
+        task, history, archive, outbox = (Task.__table__, TaskHistory.__table__,
+                                          TaskArchive.__table__, SyncOutbox.__table__)
+        params = {"company_id": company_id}
+        tasks = "SELECT id FROM main.task WHERE company_id = :company_id"
+        task_ids = f"{tasks} UNION SELECT id FROM main.taskarchive WHERE company_id = :company_id"
+        task_outbox = f"table_name = 'task' AND record_id IN ({tasks})"
+
+        with self.local_engine.connect() as connection:
+            connection.exec_driver_sql("ATTACH DATABASE ? AS shard", (path,))
+            connection.commit()
+            try:
+                with connection.begin():
+                    # Копия от прерванного переноса: история и outbox получают новые id, поэтому удаляются заново
+                    connection.execute(text(f"DELETE FROM shard.taskhistory WHERE task_id IN ({task_ids})"), params)
+                    connection.execute(text(f"DELETE FROM shard.syncoutbox WHERE {task_outbox}"), params)
+                    # Задачи и архив сохраняют id: на них ссылается история
+                    moved = connection.execute(text(
+                        f"INSERT OR REPLACE INTO shard.task ({columns(task)}) "
+                        f"SELECT {columns(task)} FROM main.task WHERE company_id = :company_id"
+                    ), params).rowcount
+                    archived = connection.execute(text(
+                        f"INSERT OR REPLACE INTO shard.taskarchive ({columns(archive)}) "
+                        f"SELECT {columns(archive)} FROM main.taskarchive WHERE company_id = :company_id"
+                    ), params).rowcount
+                    # История и outbox получают новые id в файле компании, порядок сохраняется
+                    connection.execute(text(
+                        f"INSERT INTO shard.taskhistory ({columns(history, False)}) "
+                        f"SELECT {columns(history, False)} FROM main.taskhistory WHERE task_id IN ({task_ids}) ORDER BY id"
+                    ), params)
+                    connection.execute(text(
+                        f"INSERT INTO shard.syncoutbox ({columns(outbox, False)}) "
+                        f"SELECT {columns(outbox, False)} FROM main.syncoutbox WHERE {task_outbox} ORDER BY id"
+                    ), params)
+
+                with connection.begin():
+                    connection.execute(text(f"DELETE FROM main.taskhistory WHERE task_id IN ({task_ids})"), params)
+                    connection.execute(text(f"DELETE FROM main.syncoutbox WHERE {task_outbox}"), params)
+                    connection.execute(text("DELETE FROM main.task WHERE company_id = :company_id"), params)
+                    connection.execute(text("DELETE FROM main.taskarchive WHERE company_id = :company_id"), params)
+            finally:
+                connection.exec_driver_sql("DETACH DATABASE shard")
+        return moved, archived
+
     def get_remote_session(self):
         if self.remote_engine and self.is_online:
             return Session(self.remote_engine)
@@ -77,4 +418,27 @@ def create_db_and_tables():
     db_manager.init_databases()
 
 def get_db():
-    return db_manager.get_session()
+    yield from db_manager.get_session()
+
+async def get_async_db():
+    """Зависимость FastAPI: асинхронная сессия, закрывается после ответа"""
+    async for session in db_manager.get_async_session():
+        yield session
+
+async def run_local_write(fn, company_id=None):
+    """Запись из обработчика API через поток записи: fn(session) выполняется в общей пачке,
+    результат возвращается после коммита. company_id — для записи задач компании"""
+    return await asyncio.wrap_future(db_manager.get_company_writer(company_id).submit(fn))
+
+async def save_record(record, company_id=None):
+    """Добавить запись через поток записи; возвращает ее с заполненным id"""
+    def write(session):
+        session.add(record)
+        session.flush()
+        return record
+    return await run_local_write(write, company_id)
+
+async def get_company_db(company_id: int):
+    """Зависимость FastAPI: асинхронная сессия для задач компании из пути запроса"""
+    async with db_manager.get_company_async_session(company_id, create=False) as session:
+        yield session
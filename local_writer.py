@@ -0,0 +1,95 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from sqlmodel import Session
+from outbox import SKIP_OUTBOX
+
+# Сколько заданий записи фиксируется одним коммитом
+LOCAL_WRITE_BATCH_MAX = int(os.getenv("LOCAL_WRITE_BATCH_MAX", "64"))
+# Сколько ждать следующих заданий перед коммитом (мс). 0 — коммитим то, что уже накопилось в очереди
+LOCAL_WRITE_BATCH_WINDOW = float(os.getenv("LOCAL_WRITE_BATCH_WINDOW_MS", "0")) / 1000
+
+
+class LocalWriteCoordinator:
+    """Единственный поток записи в файл SQLite
+
+    Задания от обработчиков API и синхронизации собираются в пачки: каждое выполняется
+    в своей точке сохранения, а пачка фиксируется одним коммитом (group commit).
+    Ошибка задания откатывает только его точку сохранения. Задание — функция fn(session),
+    она не должна вызывать commit; ее результат возвращается через Future после коммита
+    """
+
+    def __init__(self, engine, name: str = "local-writer"):
+        self.engine = engine
+        self._queue = queue.Queue()
+        self._stats = {"commits": 0, "writes": 0, "failed": 0, "max_batch": 0}
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, fn, skip_outbox: bool = False) -> Future:
+        """Ставим задание в очередь. skip_outbox=True — изменения пришли из Supabase"""
+        if threading.current_thread() is self._thread:
+            # Задание ждало бы само себя
+            raise RuntimeError("Нельзя ставить запись в очередь из задания записи")
+        future = Future()
+        self._queue.put((fn, skip_outbox, future))
+        return future
+
+    def run(self, fn, skip_outbox: bool = False):
+        """Выполнить задание и дождаться коммита (для потоков синхронизации)"""
+        return self.submit(fn, skip_outbox).result()
+
+    def snapshot(self) -> dict:
+        stats = dict(self._stats)
+        stats["queued"] = self._queue.qsize()
+        stats["avg_batch"] = round(stats["writes"] / stats["commits"], 2) if stats["commits"] else 0
+        return stats
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + LOCAL_WRITE_BATCH_WINDOW
+            while len(batch) < LOCAL_WRITE_BATCH_MAX:
+                try:
+                    timeout = deadline - time.monotonic()
+                    batch.append(self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._commit_batch(batch)
+
+    def _commit_batch(self, batch):
+        done = []
+        # expire_on_commit=False: объекты из результатов доступны после коммита в других потоках
+        with Session(self.engine, expire_on_commit=False) as session:
+            for fn, skip_outbox, future in batch:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                session.info[SKIP_OUTBOX] = skip_outbox
+                try:
+                    with session.begin_nested():
+                        result = fn(session)
+                    done.append((future, result))
+                except Exception as e:
+                    self._stats["failed"] += 1
+                    future.set_exception(e)
+
+            if not done:
+                session.rollback()
+                return
+            try:
+                session.commit()
+            except Exception as e:
+                session.rollback()
+                self._stats["failed"] += len(done)
+                for future, _ in done:
+                    future.set_exception(e)
+                return
+            session.expunge_all()
+
+        self._stats["commits"] += 1
+        self._stats["writes"] += len(done)
+        self._stats["max_batch"] = max(self._stats["max_batch"], len(done))
+        for future, result in done:
+            future.set_result(result)
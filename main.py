@@ -1,26 +1,44 @@
-from fastapi import FastAPI, Depends, BackgroundTasks, HTTPException
+from fastapi import FastAPI, Depends, HTTPException, Query, Header, Response
+from fastapi.responses import JSONResponse
 from fastapi.security import HTTPBasicCredentials
-from sqlmodel import Session, select
-from database import create_db_and_tables, get_db
+from sqlmodel import select
+from sqlalchemy import and_, or_
+from typing import List, Optional
+from sqlmodel.ext.asyncio.session import AsyncSession
+from database import create_db_and_tables, get_async_db, get_company_db, LOCAL_SHARDING, run_local_write, save_record
 from sync_service import sync_service
 import asyncio
-from models import User, UserStatus, Task, TaskPriority, TaskStatus, Company
+import os
+from pydantic import ValidationError
+from models import User, UserStatus, Task, TaskArchive, TaskCreate, TaskPriority, TaskStatus, TaskUpdate, Company
 from datetime import date, datetime
 from database import db_manager
 from auth import get_current_user, hash_password, verify_password
+from pagination import API_PAGE_SIZE, API_PAGE_SIZE_MAX, fetch_page, parse_fields
+from company_revision import read_etag, etag_matches
+from change_feed import encode_feed_cursor, decode_feed_cursor, feed_state, read_feed
 from fastapi.security import HTTPBasic
 
 security = HTTPBasic()
 
+# Максимум задач в одном запросе /tasks/bulk
+TASK_BULK_MAX = int(os.getenv("TASK_BULK_MAX", "1000"))
+
 app = FastAPI(title="Task Manager")
 
 @app.on_event("startup")
 async def startup_event():
-    # Инициализация базы данных
+    # Инициализация локальной базы (Supabase подключается в фоне планировщиком синхронизации)
     create_db_and_tables()
     
-    # Запуск фоновой синхронизации
-    asyncio.create_task(sync_service.start_sync())
+    # Запуск фоновой синхронизации (ссылка на задачу — чтобы ее не собрал сборщик мусора)
+    app.state.sync_task = asyncio.create_task(sync_service.start_sync())
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    app.state.sync_task.cancel()
+    sync_service.shutdown()
+    await db_manager.local_async_engine.dispose()
 
 @app.get("/")
 async def root():
@@ -28,36 +46,65 @@ async def root():
 
 @app.get("/health")
 async def health_check():
-    from database import db_manager
+    """Liveness: процесс жив и отвечает, базы не опрашиваются"""
     return {
         "status": "healthy", 
         "online": db_manager.is_online,
         "supabase_connected": db_manager.is_online
     }
 
+@app.get("/ready")
+async def readiness_check():
+    """Readiness: локальная база готова обслуживать запросы. Supabase не обязателен (оффлайн режим)"""
+    ready = db_manager.local_ready
+    return JSONResponse(
+        status_code=200 if ready else 503,
+        content={
+            "ready": ready,
+            "local_db": db_manager.local_ready,
+            "supabase": db_manager.remote_state,
+            "supabase_schema_ready": db_manager.remote_schema_ready
+        }
+    )
+
 @app.get("/sync/now")
-async def manual_sync(background_tasks: BackgroundTasks):
-    """Ручной запуск синхронизации"""
-    background_tasks.add_task(sync_service.sync_data)
-    return {"message": "Синхронизация запущена"}
+async def manual_sync(wait: bool = False):
+    """Ручной запуск синхронизации (если она уже идет — присоединяемся к ней)"""
+    future, started = sync_service.request_sync()
+    if wait:
+        try:
+            await asyncio.wrap_future(future)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Ошибка синхронизации: {e}")
+
+    return {
+        "message": "Синхронизация запущена" if started else "Синхронизация уже выполняется",
+        "started": started,
+        "status": sync_service.get_status()
+    }
+
+@app.get("/sync/status")
+async def sync_status():
+    """Состояние фоновой синхронизации"""
+    return sync_service.get_status()
+
+@app.get("/sync/stats")
+async def sync_stats():
+    """Метрики синхронизации: время фаз, строки, обращения к Supabase, ошибки, очередь изменений"""
+    # Очередь изменений считается запросами ко всем файлам SQLite — не в event loop
+    return await asyncio.to_thread(sync_service.get_stats)
 
 # ============ КОМПАНИИ ==============
 
 @app.post("/companies/")
-async def create_company(
-    company_data: dict,
-    db: Session = Depends(get_db)
-):
+async def create_company(company_data: dict):
     """Создание новой компании"""
-    session = next(db)
     try:
         company = Company(
             title=company_data.get("title"),
             description=company_data.get("description")
         )
-        session.add(company)
-        session.commit()
-        session.refresh(company)
+        company = await save_record(company)
         
         return {
             "message": "Компания создана!",
@@ -65,26 +112,29 @@ async def create_company(
         }
         
     except Exception as e:
-        session.rollback()
         raise HTTPException(status_code=500, detail=f"Ошибка создания компании: {e}")
 
 @app.get("/companies/")
-async def get_all_companies(db: Session = Depends(get_db)):
-    """Получить все компании"""
-    session = next(db)
-    companies = session.exec(select(Company)).all()
+async def get_all_companies(
+    limit: int = Query(API_PAGE_SIZE, ge=1, le=API_PAGE_SIZE_MAX),
+    cursor: str = None,
+    fields: str = None,
+    session: AsyncSession = Depends(get_async_db)
+):
+    """Получить компании (постранично: next_cursor — курсор следующей страницы)"""
+    page = await fetch_page(session, Company, None, limit, cursor, fields)
     return {
-        "count": len(companies),
-        "companies": companies
+        "count": page["count"],
+        "companies": page["items"],
+        "next_cursor": page["next_cursor"]
     }
 
 @app.get("/companies/{company_id}")
-async def get_company(company_id: int, db: Session = Depends(get_db)):
+async def get_company(company_id: int, session: AsyncSession = Depends(get_async_db)):
     """Получить компанию по ID"""
-    session = next(db)
-    company = session.exec(
+    company = (await session.exec(
         select(Company).where(Company.id == company_id)
-    ).first()
+    )).first()
     
     if not company:
         raise HTTPException(status_code=404, detail="Компания не найдена")
@@ -94,12 +144,8 @@ async def get_company(company_id: int, db: Session = Depends(get_db)):
 # ============ ПОЛЬЗОВАТЕЛИ ==============
 
 @app.post("/users/")
-async def create_user(
-    user_data: dict,
-    db: Session = Depends(get_db)
-):
+async def create_user(user_data: dict):
     """Создание нового пользователя"""
-    session = next(db)
     try:
         user = User(
             user_name=user_data.get("user_name"),
@@ -110,9 +156,7 @@ async def create_user(
             status=user_data.get("status", UserStatus.EMPLOYEE),
             company_id=user_data.get("company_id")
         )
-        session.add(user)
-        session.commit()
-        session.refresh(user)
+        user = await save_record(user)
         
         return {
             "message": "Пользователь создан!",
@@ -120,30 +164,110 @@ async def create_user(
         }
         
     except Exception as e:
-        session.rollback()
         raise HTTPException(status_code=500, detail=f"Ошибка создания пользователя: {e}")
 
 @app.get("/companies/{company_id}/users")
-async def get_company_users(company_id: int, db: Session = Depends(get_db)):
-    """Получить пользователей компании"""
-    session = next(db)
-    users = session.exec(
-        select(User).where(User.company_id == company_id)
-    ).all()
+async def get_company_users(
+    company_id: int,
+    response: Response,
+    limit: int = Query(API_PAGE_SIZE, ge=1, le=API_PAGE_SIZE_MAX),
+    cursor: str = None,
+    fields: str = None,
+    if_none_match: Optional[str] = Header(None),
+    session: AsyncSession = Depends(get_async_db)
+):
+    """Получить пользователей компании (постранично, без хэшей паролей)"""
+    # ETag по счетчику изменений компании: 304 без чтения пользователей
+    etag = await read_etag(session, company_id)
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    response.headers["ETag"] = etag
+    page = await fetch_page(session, User, User.company_id == company_id, limit, cursor, fields, hidden=("password",))
     
     return {
-        "count": len(users),
-        "users": users
+        "count": page["count"],
+        "users": page["items"],
+        "next_cursor": page["next_cursor"]
     }
 
+@app.get("/companies/{company_id}/changes")
+async def get_company_changes(
+    company_id: int,
+    since: str = None,
+    limit: int = Query(API_PAGE_SIZE, ge=1, le=API_PAGE_SIZE_MAX),
+    session: AsyncSession = Depends(get_async_db),
+    task_session: AsyncSession = Depends(get_company_db)
+):
+    """Изменения задач и пользователей компании после курсора since
+
+    Без since возвращается только текущий курсор: клиент берет его, загружает списки
+    и дальше запрашивает изменения. Удаленные, архивированные и перенесенные в другую
+    компанию записи приходят в tombstones. 410 — курсор старше хранимой ленты, списки
+    нужно загрузить заново
+    """
+    # Пользователи — в основной базе, задачи — в файле компании (в режиме шардов).
+    # Файла компании может еще не быть: тогда позиция задач [0, 0]
+    if not LOCAL_SHARDING:
+        sources = [(session, ("user", "task"))]
+    else:
+        sources = [(session, ("user",)), (task_session if task_session.bind is not session.bind else None, ("task",))]
+    try:
+        positions = decode_feed_cursor(since) if since else None
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if positions is not None and len(positions) != len(sources):
+        raise HTTPException(status_code=410, detail="Курсор устарел, загрузите списки заново")
+
+    changed = {"user": {}, "task": {}} # id записей по порядку изменений, без повторов
+    cursor, has_more = [], False
+    for index, (source, tables) in enumerate(sources):
+        if source is None:
+            cursor.append([0, 0])
+            continue
+        epoch, lowest, highest = await feed_state(source)
+        if positions is None:
+            cursor.append([epoch, highest or 0])
+            continue
+        since_epoch, position = positions[index]
+        if since_epoch == 0:
+            # Файл компании создан после выдачи курсора — читаем его ленту с начала
+            since_epoch, position = epoch, 0
+        # Лента чистится, кроме последней записи: пропуск перед lowest — курсор из удаленной части
+        if since_epoch != epoch or position > (highest or 0) or (lowest is not None and position < lowest - 1):
+            raise HTTPException(status_code=410, detail="Курсор устарел, загрузите списки заново")
+        entries, more = await read_feed(source, company_id, position, tables, limit)
+        has_more = has_more or more
+        for _, table_name, record_id in entries:
+            changed[table_name][record_id] = None
+        cursor.append([epoch, entries[-1][0] if entries else position])
+
+    result = {"tasks": [], "users": [], "tombstones": []}
+    for table_name, model, source, hidden, key in (
+        ("task", Task, task_session, (), "tasks"),
+        ("user", User, session, ("password",), "users"),
+    ):
+        ids = list(changed[table_name])
+        if not ids:
+            continue
+        columns = [model.__table__.c[name] for name in parse_fields(model, hidden=hidden)]
+        rows = {row["id"]: row for row in (await source.execute(
+            select(*columns).where(model.__table__.c.id.in_(ids))
+        )).mappings().all()}
+        for record_id in ids:
+            row = rows.get(record_id)
+            if row is None or row["company_id"] != company_id or row["is_deleted"]:
+                result["tombstones"].append({"table": table_name, "id": record_id})
+            else:
+                result[key].append(dict(row))
+
+    return {**result, "cursor": encode_feed_cursor(cursor), "has_more": has_more}
+
 @app.get("/users/{user_id}")
-async def get_user(user_id: int, db: Session = Depends(get_db)):
+async def get_user(user_id: int, session: AsyncSession = Depends(get_async_db)):
     """Получить пользователя по ID"""
-    session = next(db)
-    
-    user = session.exec(
+    user = (await session.exec(
         select(User).where(User.id == user_id)
-    ).first()
+    )).first()
     
     if not user:
         raise HTTPException(status_code=404, detail="Пользователь не найден")
@@ -158,19 +282,23 @@ async def get_user(user_id: int, db: Session = Depends(get_db)):
 @app.post("/tasks/")
 async def create_task(
     task_data: dict,
-    db: Session = Depends(get_db)
+    session: AsyncSession = Depends(get_async_db)
 ):
     """Создание новой задачи"""
-    session = next(db)
     try:
         # Проверяем что исполнитель из той же компании
         if task_data.get("assignee_id"):
-            assignee = session.exec(
+            assignee = (await session.exec(
                 select(User).where(User.id == task_data.get("assignee_id"))
-            ).first()
+            )).first()
             
             if assignee and assignee.company_id != task_data.get("company_id"):
                 raise HTTPException(400, "Исполнитель не из вашей компании")
+
+        # В режиме шардов для задачи создается файл компании — компания должна существовать
+        company_id = task_data.get("company_id")
+        if LOCAL_SHARDING and (company_id is None or not await session.get(Company, company_id)):
+            raise HTTPException(404, "Компания не найдена")
         
         task = Task(
             title=task_data.get("title"),
@@ -181,52 +309,278 @@ async def create_task(
             priority=task_data.get("priority", TaskPriority.MEDIUM),
             status=task_data.get("status", TaskStatus.TODO)
         )
-        session.add(task)
-        session.commit()
-        session.refresh(task)
+        # Задачи хранятся в базе своей компании
+        task = await save_record(task, task.company_id)
         
         return {
             "message": "Задача создана!",
             "task": task
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
-        session.rollback()
-        if "Исполнитель не из вашей компании" in str(e):
-            raise
         raise HTTPException(status_code=500, detail=f"Ошибка создания задачи: {e}")
 
+def _bulk_items(payload: dict) -> list:
+    items = payload.get("tasks")
+    if not isinstance(items, list) or not items:
+        raise HTTPException(400, "Нужен непустой список tasks")
+    if len(items) > TASK_BULK_MAX:
+        raise HTTPException(413, f"Не больше {TASK_BULK_MAX} задач за запрос")
+    return items
+
+def _bulk_error(index: int, error) -> dict:
+    if isinstance(error, ValidationError):
+        error = "; ".join(f"{'.'.join(map(str, item['loc']))}: {item['msg']}" for item in error.errors())
+    return {"index": index, "ok": False, "error": str(error)}
+
+async def _bulk_assignees(session: AsyncSession, assignee_ids: set) -> dict:
+    """Все исполнители пачки одним запросом: {id пользователя: id компании}"""
+    if not assignee_ids:
+        return {}
+    return dict((await session.exec(select(User.id, User.company_id).where(User.id.in_(assignee_ids)))).all())
+
+def _assignee_error(assignees: dict, assignee_id, company_id):
+    if assignee_id is None:
+        return None
+    if assignee_id not in assignees:
+        return "Исполнитель не найден"
+    if assignees[assignee_id] != company_id:
+        return "Исполнитель не из вашей компании"
+    return None
+
+async def _run_bulk(groups: dict, write_item, prepare=None) -> list:
+    """Одно задание потока записи (одна транзакция) на файл задач; каждая задача — в своей точке сохранения"""
+    def job(company_id, group):
+        def write(session):
+            if prepare:
+                prepare(session, group)
+            results = []
+            for index, item in group:
+                try:
+                    with session.begin_nested():
+                        task = write_item(session, item)
+                    results.append({"index": index, "ok": True, "task": task})
+                except Exception as e:
+                    results.append(_bulk_error(index, e))
+            return results
+        return run_local_write(write, company_id)
+
+    done = await asyncio.gather(*[job(company_id, group) for company_id, group in groups.items()])
+    return [result for results in done for result in results]
+
+def _bulk_response(items: list, results: list) -> dict:
+    results.sort(key=lambda result: result["index"])
+    succeeded = sum(result["ok"] for result in results)
+    return {"count": len(items), "succeeded": succeeded, "failed": len(results) - succeeded, "results": results}
+
+@app.post("/tasks/bulk")
+async def create_tasks_bulk(payload: dict, session: AsyncSession = Depends(get_async_db)):
+    """Создание задач пачкой: {"tasks": [...]}, результат по каждой задаче"""
+    items = _bulk_items(payload)
+    results, valid = [], {}
+    for index, item in enumerate(items):
+        try:
+            data = TaskCreate.model_validate(item)
+        except ValidationError as e:
+            results.append(_bulk_error(index, e))
+            continue
+        if data.company_id is None:
+            results.append(_bulk_error(index, "company_id обязателен"))
+            continue
+        valid[index] = data
+
+    # Компании и исполнители проверяются одним запросом IN на всю пачку
+    company_ids = {data.company_id for data in valid.values()}
+    companies = set((await session.exec(select(Company.id).where(Company.id.in_(company_ids)))).all()) if company_ids else set()
+    assignees = await _bulk_assignees(session, {data.assignee_id for data in valid.values() if data.assignee_id})
+
+    groups = {}
+    for index, data in valid.items():
+        error = "Компания не найдена" if data.company_id not in companies \
+            else _assignee_error(assignees, data.assignee_id, data.company_id)
+        if error:
+            results.append(_bulk_error(index, error))
+            continue
+        # Задачи хранятся в базе своей компании
+        groups.setdefault(data.company_id if LOCAL_SHARDING else None, []).append((index, data))
+
+    def create(write_session, data):
+        task = Task(**data.model_dump())
+        write_session.add(task)
+        return task
+
+    results += await _run_bulk(groups, create)
+    return _bulk_response(items, results)
+
+@app.patch("/tasks/bulk")
+async def update_tasks_bulk(payload: dict, session: AsyncSession = Depends(get_async_db)):
+    """Изменение задач пачкой: {"tasks": [{"id": ..., поля}]}, результат по каждой задаче
+
+    company_id задачи указывает, где ее искать (в режиме шардов обязателен), и не меняется
+    """
+    items = _bulk_items(payload)
+    results, valid = [], {}
+    for index, item in enumerate(items):
+        try:
+            if not isinstance(item, dict) or not isinstance(item.get("id"), int):
+                raise ValueError("id задачи обязателен")
+            changes = TaskUpdate.model_validate(item).model_dump(exclude_unset=True)
+        except (ValidationError, ValueError) as e:
+            results.append(_bulk_error(index, e))
+            continue
+        company_id = changes.pop("company_id", None)
+        if LOCAL_SHARDING and company_id is None:
+            results.append(_bulk_error(index, "company_id обязателен"))
+            continue
+        valid[index] = (item["id"], company_id, changes)
+
+    assignees = await _bulk_assignees(
+        session, {changes["assignee_id"] for _, _, changes in valid.values() if changes.get("assignee_id")}
+    )
+
+    groups = {}
+    for index, change in valid.items():
+        groups.setdefault(change[1] if LOCAL_SHARDING else None, []).append((index, change))
+
+    def update(write_session, change):
+        task_id, company_id, changes = change
+        task = write_session.get(Task, task_id)
+        if not task or (company_id is not None and task.company_id != company_id):
+            raise LookupError("Задача не найдена")
+        error = _assignee_error(assignees, changes.get("assignee_id"), task.company_id)
+        if error:
+            raise ValueError(error)
+        for field, value in changes.items():
+            setattr(task, field, value)
+        return task
+
+    def preload(write_session, group):
+        # Задачи группы загружаются одним запросом, дальше write_session.get берет их из identity map
+        write_session.exec(select(Task).where(Task.id.in_([change[0] for _, change in group]))).all()
+
+    results += await _run_bulk(groups, update, preload)
+    return _bulk_response(items, results)
+
+def task_filters(
+    status: Optional[List[TaskStatus]] = Query(None),
+    priority: Optional[List[TaskPriority]] = Query(None),
+    assignee_id: Optional[int] = None,
+    due_from: Optional[date] = None,
+    due_to: Optional[date] = None,
+    overdue: Optional[bool] = None,
+    is_deleted: Optional[bool] = None
+) -> list:
+    """Фильтры списков задач: условия выполняются в SQL по индексированным колонкам"""
+    conditions = []
+    if status:
+        conditions.append(Task.status.in_(status))
+    if priority:
+        conditions.append(Task.priority.in_(priority))
+    if assignee_id is not None:
+        conditions.append(Task.assignee_id == assignee_id)
+    if due_from is not None:
+        conditions.append(Task.due_date >= due_from)
+    if due_to is not None:
+        conditions.append(Task.due_date <= due_to)
+    if overdue is not None:
+        # Просрочена: срок прошел, а задача не выполнена
+        today = date.today()
+        if overdue:
+            conditions.append((Task.due_date < today) & (Task.status != TaskStatus.DONE))
+        else:
+            conditions.append(or_(Task.due_date == None, Task.due_date >= today, Task.status == TaskStatus.DONE))
+    if is_deleted is not None:
+        conditions.append(Task.is_deleted == is_deleted)
+    return conditions
+
 @app.get("/companies/{company_id}/tasks")
-async def get_company_tasks(company_id: int, db: Session = Depends(get_db)):
-    """Получить задачи компании"""
-    session = next(db)
-    tasks = session.exec(
-        select(Task).where(Task.company_id == company_id)
-    ).all()
+async def get_company_tasks(
+    company_id: int,
+    response: Response,
+    limit: int = Query(API_PAGE_SIZE, ge=1, le=API_PAGE_SIZE_MAX),
+    cursor: str = None,
+    fields: str = None,
+    sort: str = None,
+    filters: list = Depends(task_filters),
+    if_none_match: Optional[str] = Header(None),
+    session: AsyncSession = Depends(get_company_db)
+):
+    """Получить задачи компании (фильтры, сортировка sort=due_date / -updated_at, постранично)"""
+    # ETag по счетчику изменений компании: 304 без чтения задач
+    etag = await read_etag(session, company_id)
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    response.headers["ETag"] = etag
+    page = await fetch_page(session, Task, and_(Task.company_id == company_id, *filters), limit, cursor, fields, sort=sort)
+    
+    return {
+        "count": page["count"],
+        "tasks": page["items"],
+        "next_cursor": page["next_cursor"]
+    }
+
+@app.get("/companies/{company_id}/tasks/archive")
+async def get_company_archived_tasks(
+    company_id: int,
+    limit: int = Query(API_PAGE_SIZE, ge=1, le=API_PAGE_SIZE_MAX),
+    cursor: str = None,
+    fields: str = None,
+    sort: str = None,
+    session: AsyncSession = Depends(get_company_db)
+):
+    """Получить архивные (давно выполненные и удаленные) задачи компании, постранично (по умолчанию — недавно архивированные первыми)"""
+    page = await fetch_page(session, TaskArchive, TaskArchive.company_id == company_id, limit, cursor, fields,
+                            sort=sort, default_sort="-archived_at")
     
     return {
-        "count": len(tasks),
-        "tasks": tasks
+        "count": page["count"],
+        "tasks": page["items"],
+        "next_cursor": page["next_cursor"]
+    }
+
+@app.post("/companies/{company_id}/tasks/archive/{task_id}/restore")
+async def restore_archived_task(company_id: int, task_id: int, session: AsyncSession = Depends(get_company_db)):
+    """Вернуть задачу из архива в работу"""
+    archived = await session.get(TaskArchive, task_id)
+    if not archived or archived.company_id != company_id:
+        raise HTTPException(status_code=404, detail="Задача в архиве не найдена")
+    restored_id = await run_local_write(lambda write_session: sync_service.archiver.restore(write_session, task_id), company_id)
+    if restored_id is None:
+        raise HTTPException(status_code=404, detail="Задача в архиве не найдена")
+    
+    task = await session.get(Task, restored_id)
+    return {
+        "message": "Задача возвращена из архива!",
+        "task": task
     }
 
 @app.get("/my/tasks")
 async def get_my_tasks(
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    response: Response,
+    limit: int = Query(API_PAGE_SIZE, ge=1, le=API_PAGE_SIZE_MAX),
+    cursor: str = None,
+    fields: str = None,
+    sort: str = None,
+    filters: list = Depends(task_filters),
+    if_none_match: Optional[str] = Header(None),
+    current_user: User = Depends(get_current_user)
 ):
-    """Получить задачи текущего пользователя"""
-    session = next(db)
-    
-    tasks = session.exec(
-        select(Task).where(
-            (Task.company_id == current_user.company_id) &
-            (Task.assignee_id == current_user.id)
-        )
-    ).all()
+    """Получить задачи текущего пользователя (те же фильтры и страницы, что у задач компании)"""
+    where = and_(Task.company_id == current_user.company_id, Task.assignee_id == current_user.id, *filters)
+    async with db_manager.get_company_async_session(current_user.company_id, create=False) as session:
+        # Список зависит и от пользователя: его id входит в ETag
+        etag = await read_etag(session, current_user.company_id, f"u{current_user.id}")
+        if etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers={"ETag": etag})
+        response.headers["ETag"] = etag
+        page = await fetch_page(session, Task, where, limit, cursor, fields, sort=sort)
     
     return {
-        "count": len(tasks),
-        "tasks": tasks
+        "count": page["count"],
+        "tasks": page["items"],
+        "next_cursor": page["next_cursor"]
     }
 # ====================================================
 #                  АУТЕНИФАКЦИЯ
@@ -235,19 +589,18 @@ async def get_my_tasks(
 @app.post("/auth/register")
 async def register(
     user_data: dict,
-    db: Session = Depends(get_db)
+    session: AsyncSession = Depends(get_async_db)
 ):
-    session = next(db)
     try:
-        existing_user = session.exec(
+        existing_user = (await session.exec(
             select(User).where(User.email == user_data.get("email"))
-        ).first()
+        )).first()
         
         if existing_user:
             raise HTTPException(400, "Пользователь с таким email уже существует")
         
         # Хэшируем пароль
-        password_hash = hash_password(user_data.get("password", ""))
+        password_hash = await asyncio.to_thread(hash_password, user_data.get("password", ""))
         
         # Создаем пользователя
         user = User(
@@ -260,9 +613,7 @@ async def register(
             company_id=user_data.get("company_id")
         )
         
-        session.add(user)
-        session.commit()
-        session.refresh(user)
+        user = await save_record(user)
         
         return {
             "message": "Пользователь зарегистрирован!",
@@ -274,26 +625,23 @@ async def register(
     except HTTPException:
         raise
     except Exception as e:
-        session.rollback()
         raise HTTPException(status_code=500, detail=f"Ошибка регистрации: {e}")
     
 @app.post("/auth/login")
 async def login(
     credentials: HTTPBasicCredentials = Depends(security),
-    db: Session = Depends(get_db)
+    session: AsyncSession = Depends(get_async_db)
 ):
     """Вход пользователя"""
-    session = next(db)
-    
-    user = session.exec(
+    user = (await session.exec(
         select(User).where(User.email == credentials.username)  # ← ИЩЕМ ПО EMAIL
-    ).first()
+    )).first()
     
     if not user:
         raise HTTPException(401, "Неверный email или пароль")
     
     # Упрощенная проверка: пароль должен быть равен email
-    if not verify_password(credentials.password, user.password):
+    if not await asyncio.to_thread(verify_password, credentials.password, user.password):
         raise HTTPException(401, "Неверный email или пароль")
     
     return {
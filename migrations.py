@@ -0,0 +1,295 @@
+# migrations.py
+import uuid
+from datetime import datetime
+from sqlalchemy import text, inspect
+from sqlmodel import SQLModel
+from models import SchemaVersion, TaskArchive, CompanyRevision, ChangeFeed, SyncPullFailure
+from company_revision import create_epoch
+
+# Ключ advisory-блокировки Postgres: несколько клиентов не мигрируют Supabase одновременно
+MIGRATION_LOCK_KEY = 74210513
+
+# Таблицы, существовавшие до появления миграций. Новые таблицы создаются своими миграциями
+BASE_TABLES = ("company", "user", "task", "taskhistory", "synclog")
+# Служебные таблицы синхронизации, которые до миграций создавались локально
+LOCAL_BASE_TABLES = BASE_TABLES + ("synclogsummary", "synccursor", "syncidmap", "syncoutbox")
+
+
+def _false(connection) -> str:
+    # Литерал false в том же виде, в каком его генерирует SQLAlchemy (иначе SQLite не применит частичный индекс)
+    return "0" if connection.dialect.name == "sqlite" else "false"
+
+
+def _add_missing_columns(connection, tables):
+    # create_all не меняет существующие таблицы: добавляем новые колонки и индексы моделей
+    inspector = inspect(connection)
+    for table in tables:
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            column_type = column.type.compile(dialect=connection.dialect)
+            ddl = f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {column_type}'
+            if column.server_default is not None:
+                ddl += f" DEFAULT {column.server_default.arg}"
+                if not column.nullable:
+                    ddl += " NOT NULL"
+            connection.execute(text(ddl))
+            print(f"🔧 Добавлена колонка {table.name}.{column.name}")
+
+        for index in table.indexes:
+            index.create(connection, checkfirst=True)
+
+
+def _base_schema(connection, remote: bool):
+    """Таблицы моделей и колонки, добавленные до появления миграций
+
+    Список таблиц зафиксирован: локальные служебные таблицы в Supabase не создаются
+    """
+    names = BASE_TABLES if remote else LOCAL_BASE_TABLES
+    tables = [SQLModel.metadata.tables[name] for name in names]
+    SQLModel.metadata.create_all(connection, tables=tables)
+    _add_missing_columns(connection, tables)
+
+
+def _upsert_indexes(connection, remote: bool):
+    """Уникальные индексы по supabase_id для INSERT ... ON CONFLICT при пакетной отправке"""
+    if not remote:
+        return
+    for table_name in ("company", "user", "task"):
+        # Старые клиенты выдавали supabase_id из локального id (local_{id}), и записи разных
+        # узлов могли совпасть. Первая запись сохраняет supabase_id, остальные переименовываются
+        renamed = connection.execute(text(
+            f'UPDATE "{table_name}" SET supabase_id = supabase_id || \'-dup-\' || id '
+            f'WHERE supabase_id IS NOT NULL AND EXISTS ('
+            f'SELECT 1 FROM "{table_name}" AS first WHERE first.supabase_id = "{table_name}".supabase_id '
+            f'AND first.id < "{table_name}".id)'
+        )).rowcount
+        if renamed:
+            print(f"⚠️ В {table_name} переименовано записей с повторяющимся supabase_id: {renamed}")
+        connection.execute(text(
+            f'CREATE UNIQUE INDEX IF NOT EXISTS ux_{table_name}_supabase_id ON "{table_name}" (supabase_id)'
+        ))
+
+
+def _hot_path_indexes(connection, remote: bool):
+    """Составные и частичные индексы под реальные запросы API и синхронизации"""
+    false = _false(connection)
+    statements = [
+        # /my/tasks
+        'CREATE INDEX IF NOT EXISTS ix_task_company_id_assignee_id ON task (company_id, assignee_id)',
+        # Задачи компании по статусу и сроку
+        'CREATE INDEX IF NOT EXISTS ix_task_company_id_status_due_date ON task (company_id, status, due_date)',
+        # Живые (не удаленные) записи компании
+        f'CREATE INDEX IF NOT EXISTS ix_task_company_id_not_deleted ON task (company_id) WHERE is_deleted = {false}',
+        f'CREATE INDEX IF NOT EXISTS ix_user_company_id_not_deleted ON "user" (company_id) WHERE is_deleted = {false}',
+    ]
+    if remote:
+        # Инкрементальная выгрузка изменений идет по (updated_at, id)
+        statements += [
+            f'CREATE INDEX IF NOT EXISTS ix_{table_name}_updated_at_id ON "{table_name}" (updated_at, id)'
+            for table_name in ("company", "user", "task")
+        ]
+    else:
+        # Записи, еще не отправленные в Supabase (дозаполнение outbox)
+        statements += [
+            f'CREATE INDEX IF NOT EXISTS ix_{table_name}_unsynced ON "{table_name}" (id) WHERE is_synced = {false}'
+            for table_name in ("company", "user", "task")
+        ]
+    for statement in statements:
+        connection.execute(text(statement))
+
+    # Email уникален, но в старых базах могут быть дубли — тогда только обычный индекс
+    duplicate = connection.execute(text(
+        'SELECT email FROM "user" GROUP BY email HAVING COUNT(*) > 1 LIMIT 1'
+    )).first()
+    if duplicate:
+        print(f"⚠️ Найдены пользователи с одинаковым email ({duplicate[0]}), уникальный индекс не создан")
+        connection.execute(text('CREATE INDEX IF NOT EXISTS ix_user_email ON "user" (email)'))
+    else:
+        connection.execute(text('CREATE UNIQUE INDEX IF NOT EXISTS ux_user_email ON "user" (email)'))
+
+
+def _task_archive(connection, remote: bool):
+    """Архив выполненных и удаленных задач (только локально)"""
+    if remote:
+        return
+    TaskArchive.__table__.create(connection, checkfirst=True)
+
+
+def _sync_cursor_scope(connection, remote: bool):
+    """Область репликации в курсорах выгрузки (только локально)"""
+    if remote:
+        return
+    columns = {column["name"] for column in inspect(connection).get_columns("synccursor")}
+    if "scope" not in columns:
+        connection.execute(text('ALTER TABLE synccursor ADD COLUMN scope VARCHAR'))
+
+
+def _list_page_indexes(connection, remote: bool):
+    """Постраничные списки API идут по ключу (updated_at, id) внутри компании (только локально)"""
+    if remote:
+        return
+    for statement in (
+        'CREATE INDEX IF NOT EXISTS ix_company_updated_at_id ON company (updated_at, id)',
+        'CREATE INDEX IF NOT EXISTS ix_user_company_id_updated_at_id ON "user" (company_id, updated_at, id)',
+        'CREATE INDEX IF NOT EXISTS ix_task_company_id_updated_at_id ON task (company_id, updated_at, id)',
+    ):
+        connection.execute(text(statement))
+
+
+def _task_filter_indexes(connection, remote: bool):
+    """Фильтры и сортировки списков задач API (только локально)"""
+    if remote:
+        return
+    for statement in (
+        'CREATE INDEX IF NOT EXISTS ix_task_company_id_priority ON task (company_id, priority)',
+        'CREATE INDEX IF NOT EXISTS ix_task_company_id_due_date_id ON task (company_id, due_date, id)',
+        'CREATE INDEX IF NOT EXISTS ix_task_company_id_created_at_id ON task (company_id, created_at, id)',
+        # /my/tasks по умолчанию: исполнитель и порядок (updated_at, id)
+        'CREATE INDEX IF NOT EXISTS ix_task_company_id_assignee_id_updated_at_id ON task (company_id, assignee_id, updated_at, id)',
+    ):
+        connection.execute(text(statement))
+
+
+def _company_revisions(connection, remote: bool):
+    """Счетчики изменений компаний для ETag списков (только локально)"""
+    if remote:
+        return
+    CompanyRevision.__table__.create(connection, checkfirst=True)
+    create_epoch(connection)
+
+
+def _change_feed(connection, remote: bool):
+    """Лента изменений для /companies/{id}/changes (только локально)"""
+    if remote:
+        return
+    ChangeFeed.__table__.create(connection, checkfirst=True)
+
+
+def _local_supabase_ids(connection, remote: bool):
+    """supabase_id для локальных записей, еще не отправленных в Supabase (только локально)
+
+    Раньше он выдавался при отправке из локального id и совпадал у записей разных узлов
+    """
+    if remote:
+        return
+    for table_name in ("company", "user", "task"):
+        ids = connection.execute(text(f'SELECT id FROM "{table_name}" WHERE supabase_id IS NULL')).scalars().all()
+        if ids:
+            connection.execute(
+                text(f'UPDATE "{table_name}" SET supabase_id = :supabase_id WHERE id = :id'),
+                [{"id": record_id, "supabase_id": str(uuid.uuid4())} for record_id in ids]
+            )
+            print(f"🔧 Выданы supabase_id для {len(ids)} записей {table_name}")
+
+
+def _outbox_attempts(connection, remote: bool):
+    """Счетчик неудачных попыток отправки в outbox (только локально)"""
+    if remote:
+        return
+    columns = {column["name"] for column in inspect(connection).get_columns("syncoutbox")}
+    if "attempts" not in columns:
+        connection.execute(text('ALTER TABLE syncoutbox ADD COLUMN attempts INTEGER DEFAULT 0 NOT NULL'))
+    if "last_error" not in columns:
+        connection.execute(text('ALTER TABLE syncoutbox ADD COLUMN last_error VARCHAR'))
+
+
+def _edited_at(connection, remote: bool):
+    """Время правки записи по часам клиента — для last writer wins при слиянии"""
+    tables = ["company", "user", "task"] if remote else ["company", "user", "task", "taskarchive"]
+    column_type = "TIMESTAMP" if connection.dialect.name == "postgresql" else "DATETIME"
+    inspector = inspect(connection)
+    for table_name in tables:
+        columns = {column["name"] for column in inspector.get_columns(table_name)}
+        if "edited_at" not in columns:
+            connection.execute(text(f'ALTER TABLE "{table_name}" ADD COLUMN edited_at {column_type}'))
+
+
+def _outbox_base_values(connection, remote: bool):
+    """Значения полей до локальной правки в outbox — для слияния по полям (только локально)"""
+    if remote:
+        return
+    columns = {column["name"] for column in inspect(connection).get_columns("syncoutbox")}
+    if "base_values" not in columns:
+        connection.execute(text('ALTER TABLE syncoutbox ADD COLUMN base_values VARCHAR'))
+
+
+def _sync_cursor_settled_at(connection, remote: bool):
+    """Граница полученных записей в курсорах выгрузки (только локально)"""
+    if remote:
+        return
+    columns = {column["name"] for column in inspect(connection).get_columns("synccursor")}
+    if "settled_at" not in columns:
+        connection.execute(text('ALTER TABLE synccursor ADD COLUMN settled_at DATETIME'))
+
+
+def _pull_failures(connection, remote: bool):
+    """Отложенные записи выгрузки из Supabase (только локально)"""
+    if remote:
+        return
+    SyncPullFailure.__table__.create(connection, checkfirst=True)
+
+
+def _archive_page_index(connection, remote: bool):
+    """Постраничный список архива идет по ключу (archived_at, id) внутри компании (только локально)"""
+    if remote:
+        return
+    connection.execute(text(
+        'CREATE INDEX IF NOT EXISTS ix_taskarchive_company_id_archived_at_id ON taskarchive (company_id, archived_at, id)'
+    ))
+
+
+# (версия, описание, функция). Новые миграции добавляются только в конец
+MIGRATIONS = [
+    (1, "base schema", _base_schema),
+    (2, "supabase_id upsert indexes", _upsert_indexes),
+    (3, "hot path composite and partial indexes", _hot_path_indexes),
+    (4, "task archive", _task_archive),
+    (5, "sync cursor replication scope", _sync_cursor_scope),
+    (6, "list page keyset indexes", _list_page_indexes),
+    (7, "task filter and sort indexes", _task_filter_indexes),
+    (8, "company change counters", _company_revisions),
+    (9, "change feed", _change_feed),
+    (10, "uuid supabase_id for local rows", _local_supabase_ids),
+    (11, "outbox push attempts", _outbox_attempts),
+    (12, "edit time for last writer wins", _edited_at),
+    (13, "outbox base values for field merge", _outbox_base_values),
+    (14, "sync cursor settled time", _sync_cursor_settled_at),
+    (15, "parked pull failures", _pull_failures),
+    (16, "archive page keyset index", _archive_page_index),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def _current_version(connection) -> int:
+    return connection.execute(text("SELECT COALESCE(MAX(version), 0) FROM schemaversion")).scalar()
+
+
+def migrate(engine, remote: bool = False) -> int:
+    """Применяет недостающие миграции, каждую в своей транзакции. Возвращает версию схемы"""
+    SchemaVersion.__table__.create(engine, checkfirst=True)
+    with engine.connect() as connection:
+        current = _current_version(connection)
+    if current >= SCHEMA_VERSION:
+        return current
+
+    for version, description, apply in MIGRATIONS:
+        if version <= current:
+            continue
+        with engine.begin() as connection:
+            if connection.dialect.name == "postgresql":
+                connection.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": MIGRATION_LOCK_KEY})
+                # Пока ждали блокировку, миграцию мог применить другой клиент
+                if _current_version(connection) >= version:
+                    continue
+            apply(connection, remote)
+            connection.execute(
+                SchemaVersion.__table__.insert().values(
+                    version=version, description=description, applied_at=datetime.utcnow()
+                )
+            )
+        current = version
+        print(f"🔧 Миграция {version} ({description}) применена")
+    return current
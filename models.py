@@ -1,4 +1,5 @@
 from sqlmodel import SQLModel, Field, Relationship
+from sqlalchemy import Index
 from typing import Optional, List
 from datetime import datetime, date
 from enum import Enum
@@ -27,8 +28,10 @@ class Company(CompanyBase, table=True):
     supabase_id: Optional[str] = Field(default=None, index=True)
     is_synced: bool = Field(default=False)
     is_deleted: bool = Field(default=False)
+    version: int = Field(default=0, sa_column_kwargs={"server_default": "0"}) # Версия записи в Supabase
     created_at: datetime = Field(default_factory=datetime.utcnow)
     updated_at: datetime = Field(default_factory=datetime.utcnow)
+    edited_at: Optional[datetime] = None # Последняя правка данных (часы клиента, который ее сделал)
 
     users: List["User"] = Relationship(back_populates="company")
     tasks: List["Task"] = Relationship(back_populates="company")    
@@ -49,13 +52,28 @@ class Task(TaskBase, table=True):
     supabase_id: Optional[str] = Field(default=None, index=True)
     is_synced: bool = Field(default=False)
     is_deleted: bool = Field(default=False)
+    version: int = Field(default=0, sa_column_kwargs={"server_default": "0"}) # Версия записи в Supabase
     created_at: datetime = Field(default_factory=datetime.utcnow)
     updated_at: datetime = Field(default_factory=datetime.utcnow)
+    edited_at: Optional[datetime] = None # Последняя правка данных (часы клиента, который ее сделал)
     
     history: List["TaskHistory"] = Relationship(back_populates="task")
     assignee: Optional["User"] = Relationship(back_populates="tasks")
     company: Optional["Company"] = Relationship(back_populates="tasks")
 
+# Архив завершенных и удаленных задач (холодные данные). id совпадает с id задачи,
+# поэтому история в TaskHistory остается привязанной к ней
+class TaskArchive(TaskBase, table=True):
+    id: int = Field(primary_key=True, sa_column_kwargs={"autoincrement": False})
+    supabase_id: Optional[str] = Field(default=None, index=True)
+    is_synced: bool = Field(default=True)
+    is_deleted: bool = Field(default=False)
+    version: int = Field(default=0)
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    updated_at: datetime = Field(default_factory=datetime.utcnow)
+    edited_at: Optional[datetime] = None
+    archived_at: datetime = Field(default_factory=datetime.utcnow)
+
 # Модель истории изменений задач мб в будущем
 class TaskHistory(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
@@ -91,8 +109,10 @@ class User(UserBase, table=True):
     supabase_id: Optional[str] = Field(default=None, index=True)
     is_synced: bool = Field(default=False)
     is_deleted: bool = Field(default=False)
+    version: int = Field(default=0, sa_column_kwargs={"server_default": "0"}) # Версия записи в Supabase
     created_at: datetime = Field(default_factory=datetime.utcnow)  
     updated_at: datetime = Field(default_factory=datetime.utcnow)
+    edited_at: Optional[datetime] = None # Последняя правка данных (часы клиента, который ее сделал)
     
     tasks: List["Task"] = Relationship(back_populates="assignee")
     company: Optional["Company"] = Relationship(back_populates="users")
@@ -171,4 +191,84 @@ class SyncLog(SQLModel, table=True):
     table_name: str # Название таблицы
     record_id: int # ID измененной записи
     supabase_id: Optional[str] = None
-    sync_timestamp: datetime = Field(default_factory=datetime.utcnow)
+    sync_timestamp: datetime = Field(default_factory=datetime.utcnow, index=True)
+
+
+# Сводка старых записей лога синхронизации (по дням), сами записи удаляются
+class SyncLogSummary(SQLModel, table=True):
+    day: date = Field(primary_key=True)
+    table_name: str = Field(primary_key=True)
+    action: str = Field(primary_key=True)
+    count: int = Field(default=0)
+
+
+# Курсор инкрементальной синхронизации (по одному на таблицу)
+class SyncCursor(SQLModel, table=True):
+    table_name: str = Field(primary_key=True) # Название таблицы
+    last_updated_at: Optional[datetime] = None # updated_at последней полученной записи
+    last_remote_id: int = Field(default=0) # id последней полученной записи (при равных updated_at)
+    scope: Optional[str] = None # Область репликации, с которой загружались изменения (None — все компании)
+    settled_at: Optional[datetime] = None # Записи Supabase с updated_at раньше этого времени уже получены (окно перед курсором не перечитывается)
+
+
+# Записи из Supabase, которые не удалось применить локально: курсор выгрузки сдвигается дальше,
+# а сами записи загружаются повторно в следующих циклах
+class SyncPullFailure(SQLModel, table=True):
+    table_name: str = Field(primary_key=True) # Название таблицы
+    supabase_id: str = Field(primary_key=True)
+    attempts: int = Field(default=0) # Неудачные попытки применения
+    last_error: Optional[str] = None # Ошибка последней неудачной попытки
+    failed_at: datetime = Field(default_factory=datetime.utcnow) # Время последней неудачной попытки
+
+
+# Соответствие идентификаторов локальной базы и Supabase (для внешних ключей при синхронизации)
+class SyncIdMap(SQLModel, table=True):
+    table_name: str = Field(primary_key=True) # Название таблицы
+    supabase_id: str = Field(primary_key=True)
+    local_id: Optional[int] = Field(default=None) # id записи в локальной базе
+    remote_id: Optional[int] = Field(default=None) # id записи в Supabase
+
+
+# Очередь локальных изменений для отправки в Supabase (пишется в той же транзакции, что и изменение)
+class SyncOutbox(SQLModel, table=True):
+    __table_args__ = (
+        Index("ix_syncoutbox_table_name_id", "table_name", "id"),
+        Index("ix_syncoutbox_table_name_record_id", "table_name", "record_id"),
+    )
+
+    id: Optional[int] = Field(default=None, primary_key=True) # Порядок изменений
+    table_name: str # Название таблицы
+    record_id: int # ID измененной записи
+    action: str # CREATE, UPDATE, DELETE
+    supabase_id: Optional[str] = None # Нужен для DELETE, когда локальной записи уже нет
+    changed_fields: Optional[str] = None # Измененные поля через запятую (для UPDATE)
+    base_values: Optional[str] = None # Значения измененных полей до правки, JSON (для UPDATE)
+    created_at: datetime = Field(default_factory=datetime.utcnow) # Время изменения (часы клиента), по нему разрешаются конфликты
+    attempts: int = Field(default=0, sa_column_kwargs={"server_default": "0"}) # Неудачные попытки отправки
+    last_error: Optional[str] = None # Ошибка последней неудачной попытки
+
+
+# Счетчик изменений компании для ETag списков API (в каждом файле базы свой)
+class CompanyRevision(SQLModel, table=True):
+    company_id: int = Field(primary_key=True) # 0 — эпоха файла базы
+    revision: int = Field(default=0)
+
+
+# Лента изменений задач и пользователей компании для /companies/{id}/changes (в каждом файле базы своя)
+class ChangeFeed(SQLModel, table=True):
+    __table_args__ = (
+        Index("ix_changefeed_company_id_id", "company_id", "id"),
+    )
+
+    id: Optional[int] = Field(default=None, primary_key=True) # Позиция в ленте
+    company_id: int
+    table_name: str # task или user
+    record_id: int
+    changed_at: datetime = Field(default_factory=datetime.utcnow, index=True)
+
+
+# Примененные миграции схемы (одна строка на версию)
+class SchemaVersion(SQLModel, table=True):
+    version: int = Field(primary_key=True)
+    description: str
+    applied_at: datetime = Field(default_factory=datetime.utcnow)
@@ -0,0 +1,118 @@
+import json
+import uuid
+from datetime import datetime
+from enum import Enum
+from sqlalchemy import event, insert, inspect
+from sqlalchemy.orm import Session
+from models import Company, User, Task, SyncOutbox
+from change_feed import record_flushed
+
+# Таблицы, изменения которых попадают в outbox
+OUTBOX_TABLES = {Company: "company", User: "user", Task: "task"}
+
+# Служебные поля синхронизации не считаются изменениями данных
+SERVICE_FIELDS = {"id", "supabase_id", "is_synced", "version", "created_at", "updated_at", "edited_at"}
+
+# Флаг в Session.info: изменения сессии пришли из Supabase и не отправляются обратно
+SKIP_OUTBOX = "skip_outbox"
+
+# Флаг в Session.info: в текущей транзакции есть записи outbox
+HAS_CHANGES = "outbox_has_changes"
+
+# Вызываются после коммита локальных изменений (например, планировщик синхронизации)
+_commit_listeners = []
+
+
+def add_commit_listener(callback):
+    """callback() вызывается после каждого коммита, добавившего записи в outbox"""
+    _commit_listeners.append(callback)
+
+
+def _tracked(session: Session, objects):
+    if session.info.get(SKIP_OUTBOX):
+        return []
+    return [obj for obj in objects if type(obj) in OUTBOX_TABLES]
+
+
+def base_value(value):
+    """Значение поля в виде, в котором оно хранится в base_values (для сравнения при слиянии)"""
+    if value is None:
+        return None
+    if isinstance(value, Enum):
+        return value.value
+    return str(value)
+
+
+def _changed_fields(obj):
+    """Измененные поля через запятую и их значения до правки (base_values, JSON)
+
+    Значение до правки известно, только если поле было загружено из базы
+    """
+    state = inspect(obj)
+    fields, bases = [], {}
+    for attr in state.mapper.column_attrs:
+        if attr.key in SERVICE_FIELDS:
+            continue
+        history = state.attrs[attr.key].history
+        if not history.has_changes():
+            continue
+        fields.append(attr.key)
+        if history.deleted:
+            bases[attr.key] = base_value(history.deleted[0])
+    return ",".join(sorted(fields)), json.dumps(bases) if bases else None
+
+
+@event.listens_for(Session, "before_flush")
+def _stamp_changes(session, flush_context, instances):
+    """Помечаем измененные записи до записи в базу"""
+    for obj in _tracked(session, session.new):
+        # supabase_id выдается при создании: глобально уникален, не зависит от локального id
+        if obj.supabase_id is None:
+            obj.supabase_id = str(uuid.uuid4())
+        obj.edited_at = obj.created_at
+    for obj in _tracked(session, session.dirty):
+        if session.is_modified(obj, include_collections=False):
+            obj.updated_at = obj.edited_at = datetime.utcnow()
+            obj.is_synced = False
+
+
+@event.listens_for(Session, "after_flush")
+def _append_outbox(session, flush_context):
+    """Добавляем записи в outbox в той же транзакции, что и сами изменения"""
+    # created_at записи outbox — время правки (edited_at), по нему разрешаются конфликты при слиянии
+    # base_values — значения полей до правки: при слиянии поле считается конфликтным, только если изменилось и в Supabase
+    entries = []
+    for obj in _tracked(session, session.new):
+        entries.append({"table_name": OUTBOX_TABLES[type(obj)], "record_id": obj.id, "action": "CREATE",
+                        "supabase_id": obj.supabase_id, "changed_fields": None, "base_values": None,
+                        "created_at": obj.edited_at})
+    for obj in _tracked(session, session.dirty):
+        if session.is_modified(obj, include_collections=False):
+            changed_fields, base_values = _changed_fields(obj)
+            entries.append({"table_name": OUTBOX_TABLES[type(obj)], "record_id": obj.id, "action": "UPDATE",
+                            "supabase_id": obj.supabase_id, "changed_fields": changed_fields,
+                            "base_values": base_values, "created_at": obj.edited_at})
+    for obj in _tracked(session, session.deleted):
+        entries.append({"table_name": OUTBOX_TABLES[type(obj)], "record_id": obj.id, "action": "DELETE",
+                        "supabase_id": obj.supabase_id, "changed_fields": None, "base_values": None,
+                        "created_at": datetime.utcnow()})
+
+    if entries:
+        session.connection().execute(insert(SyncOutbox.__table__), entries)
+        session.info[HAS_CHANGES] = True
+
+
+# Лента изменений для клиентов API пишется в той же транзакции, что и outbox
+event.listen(Session, "after_flush", record_flushed)
+
+
+@event.listens_for(Session, "after_commit")
+def _notify_commit(session):
+    if session.info.pop(HAS_CHANGES, False):
+        for callback in _commit_listeners:
+            callback()
+
+
+@event.listens_for(Session, "after_rollback")
+def _reset_changes(session):
+    session.info.pop(HAS_CHANGES, None)
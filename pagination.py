@@ -0,0 +1,100 @@
+import base64
+import json
+import os
+from fastapi import HTTPException
+from sqlalchemy import select
+
+# Размер страницы списков по умолчанию и максимальный
+API_PAGE_SIZE = int(os.getenv("API_PAGE_SIZE", "100"))
+API_PAGE_SIZE_MAX = int(os.getenv("API_PAGE_SIZE_MAX", "500"))
+
+# Поля, по которым списки сортируются с постраничным курсором (под каждое есть индекс)
+SORT_COLUMNS = ("updated_at", "created_at", "due_date", "archived_at")
+DEFAULT_SORT = "updated_at"
+
+
+def encode_cursor(sort: str, value, record_id: int) -> str:
+    """Непрозрачный курсор страницы: ключ сортировки и позиция (значение, id) последней отданной записи"""
+    raw = json.dumps([sort, value.isoformat() if value is not None else None, record_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, sort: str, column):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        cursor_sort, value, record_id = json.loads(raw)
+        if cursor_sort != sort:
+            raise ValueError(cursor_sort)
+        if value is not None:
+            value = column.type.python_type.fromisoformat(value)
+        return value, int(record_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Некорректный курсор страницы")
+
+
+def parse_sort(model, sort: str = None, default: str = DEFAULT_SORT):
+    """Сортировка: имя колонки, "-" перед именем — по убыванию. Возвращает (ключ, колонка, по убыванию)"""
+    sort = sort or default
+    name = sort.lstrip("-")
+    if name not in SORT_COLUMNS or name not in model.__table__.c:
+        available = [column for column in SORT_COLUMNS if column in model.__table__.c]
+        raise HTTPException(status_code=400, detail=f"Сортировка возможна по полям: {', '.join(available)}")
+    return sort, model.__table__.c[name], sort.startswith("-")
+
+
+def _after(column, id_column, value, record_id, descending: bool):
+    """Записи после позиции курсора. NULL меньше любого значения, как в индексе SQLite:
+    при сортировке по возрастанию записи без значения идут первыми, по убыванию — последними"""
+    if descending:
+        if value is None:
+            return column.is_(None) & (id_column < record_id)
+        beyond = (column < value) | ((column == value) & (id_column < record_id))
+        return beyond | column.is_(None) if column.nullable else beyond
+    if value is None:
+        return (column.is_(None) & (id_column > record_id)) | column.is_not(None)
+    return (column > value) | ((column == value) & (id_column > record_id))
+
+
+def parse_fields(model, fields: str = None, hidden: tuple = ()) -> list:
+    """Колонки ответа: fields= через запятую или все, кроме скрытых"""
+    available = [column.name for column in model.__table__.columns if column.name not in hidden]
+    if not fields:
+        return available
+    requested = [name.strip() for name in fields.split(",") if name.strip()]
+    unknown = [name for name in requested if name not in available]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Неизвестные поля: {', '.join(unknown)}")
+    return requested
+
+
+async def fetch_page(session, model, where, limit: int, cursor: str = None, fields: str = None,
+                     hidden: tuple = (), sort: str = None, default_sort: str = DEFAULT_SORT) -> dict:
+    """Страница записей по ключу (поле сортировки, id): запрос читает не больше limit + 1 строк
+
+    Возвращает {"count", "items", "next_cursor"}; next_cursor = None на последней странице
+    """
+    table = model.__table__
+    names = parse_fields(model, fields, hidden)
+    sort, column, descending = parse_sort(model, sort, default_sort)
+    # Ключ страницы выбирается всегда, даже если его нет в fields=
+    query = select(*[table.c[name] for name in names], column.label("_sort"), table.c.id.label("_id"))
+    if where is not None:
+        query = query.where(where)
+    if cursor:
+        value, record_id = decode_cursor(cursor, sort, column)
+        query = query.where(_after(column, table.c.id, value, record_id, descending))
+    if descending:
+        order = column.desc().nulls_last() if column.nullable else column.desc()
+        query = query.order_by(order, table.c.id.desc())
+    else:
+        order = column.asc().nulls_first() if column.nullable else column.asc()
+        query = query.order_by(order, table.c.id)
+    query = query.limit(limit + 1)
+
+    rows = (await session.execute(query)).mappings().all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(sort, rows[-1]["_sort"], rows[-1]["_id"])
+    items = [{name: row[name] for name in names} for row in rows]
+    return {"count": len(items), "items": items, "next_cursor": next_cursor}
@@ -0,0 +1,108 @@
+from sqlmodel import Session, select
+from sqlalchemy import func
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from models import Company, User, SyncIdMap
+
+# Таблицы, на которые ссылаются внешние ключи
+MAPPED_MODELS = {"company": Company, "user": User}
+
+# Ограничение длины списка в запросах IN (...)
+LOOKUP_CHUNK_SIZE = 1000
+
+
+class IdMap:
+    """Соответствие local id ↔ supabase_id ↔ remote id, загружается один раз за цикл синхронизации"""
+
+    def __init__(self):
+        self.supabase_by_local = {} # (таблица, local id) -> supabase_id
+        self.local_by_supabase = {} # (таблица, supabase_id) -> local id
+        self.remote_by_supabase = {} # (таблица, supabase_id) -> remote id
+        self._dirty = set() # Новые соответствия, которые нужно сохранить
+
+    def load(self, local_session: Session):
+        """Загружаем сохраненные соответствия и supabase_id локальных записей"""
+        for entry in local_session.exec(select(SyncIdMap)).all():
+            self._set(entry.table_name, entry.supabase_id, entry.local_id, entry.remote_id)
+
+        for table_name, model in MAPPED_MODELS.items():
+            rows = local_session.exec(select(model.id, model.supabase_id).where(model.supabase_id != None)).all()
+            for local_id, supabase_id in rows:
+                self._set(table_name, supabase_id, local_id, None)
+
+        self._dirty.clear()
+
+    def remember(self, table_name: str, supabase_id: str, local_id: int = None, remote_id: int = None):
+        """Запоминаем новое соответствие (сохраняется в базу при flush)"""
+        if table_name not in MAPPED_MODELS or not supabase_id:
+            return
+        if self._set(table_name, supabase_id, local_id, remote_id):
+            self._dirty.add((table_name, supabase_id))
+
+    def remote_id(self, table_name: str, local_id):
+        """id записи в Supabase по локальному id"""
+        supabase_id = self.supabase_by_local.get((table_name, local_id))
+        return self.remote_by_supabase.get((table_name, supabase_id))
+
+    def local_id(self, table_name: str, supabase_id):
+        """Локальный id записи по supabase_id"""
+        return self.local_by_supabase.get((table_name, supabase_id))
+
+    def prefetch_remote_ids(self, remote_session: Session, table_name: str, local_ids):
+        """Одним запросом получаем из Supabase недостающие remote id для локальных записей"""
+        missing = set()
+        for local_id in local_ids:
+            supabase_id = self.supabase_by_local.get((table_name, local_id))
+            if supabase_id and (table_name, supabase_id) not in self.remote_by_supabase:
+                missing.add(supabase_id)
+        self._fetch(remote_session, table_name, missing)
+
+    @property
+    def has_changes(self) -> bool:
+        return bool(self._dirty)
+
+    def flush(self, local_session: Session):
+        """Сохраняем новые соответствия (коммит — у вызывающего)"""
+        if not self._dirty:
+            return
+        values = [
+            {
+                "table_name": table_name,
+                "supabase_id": supabase_id,
+                "local_id": self.local_by_supabase.get((table_name, supabase_id)),
+                "remote_id": self.remote_by_supabase.get((table_name, supabase_id)),
+            }
+            for table_name, supabase_id in self._dirty
+        ]
+        for start in range(0, len(values), LOOKUP_CHUNK_SIZE):
+            stmt = sqlite_insert(SyncIdMap.__table__).values(values[start:start + LOOKUP_CHUNK_SIZE])
+            stmt = stmt.on_conflict_do_update(
+                index_elements=["table_name", "supabase_id"],
+                set_={
+                    "local_id": func.coalesce(stmt.excluded.local_id, SyncIdMap.__table__.c.local_id),
+                    "remote_id": func.coalesce(stmt.excluded.remote_id, SyncIdMap.__table__.c.remote_id),
+                }
+            )
+            local_session.execute(stmt)
+        self._dirty.clear()
+
+    def _fetch(self, remote_session: Session, table_name: str, supabase_ids):
+        model = MAPPED_MODELS[table_name]
+        keys = list(supabase_ids)
+        for start in range(0, len(keys), LOOKUP_CHUNK_SIZE):
+            rows = remote_session.exec(
+                select(model.id, model.supabase_id).where(model.supabase_id.in_(keys[start:start + LOOKUP_CHUNK_SIZE]))
+            ).all()
+            for remote_id, supabase_id in rows:
+                self.remember(table_name, supabase_id, remote_id=remote_id)
+
+    def _set(self, table_name, supabase_id, local_id, remote_id) -> bool:
+        changed = False
+        key = (table_name, supabase_id)
+        if local_id is not None and self.local_by_supabase.get(key) != local_id:
+            self.local_by_supabase[key] = local_id
+            self.supabase_by_local[(table_name, local_id)] = supabase_id
+            changed = True
+        if remote_id is not None and self.remote_by_supabase.get(key) != remote_id:
+            self.remote_by_supabase[key] = remote_id
+            changed = True
+        return changed
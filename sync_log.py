@@ -0,0 +1,70 @@
+import os
+from datetime import datetime, timedelta
+from sqlmodel import Session
+from sqlalchemy import insert, delete, select, func
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from models import SyncLog, SyncLogSummary
+
+# Сколько дней хранить подробный лог синхронизации
+SYNC_LOG_RETENTION_DAYS = int(os.getenv("SYNC_LOG_RETENTION_DAYS", "7"))
+# Как часто сворачивать старые записи в сводку (часы)
+SYNC_LOG_COMPACT_INTERVAL_HOURS = float(os.getenv("SYNC_LOG_COMPACT_INTERVAL_HOURS", "24"))
+
+
+class SyncLogWriter:
+    """Буферизованная запись SyncLog: записи копятся за фазу и пишутся одним INSERT"""
+
+    def __init__(self):
+        self._buffer = []
+        self._last_compaction = None
+
+    def add(self, action: str, table_name: str, record_id: int, supabase_id: str = None):
+        self._buffer.append({
+            "action": action,
+            "table_name": table_name,
+            "record_id": record_id,
+            "supabase_id": supabase_id,
+            "sync_timestamp": datetime.utcnow(),
+        })
+
+    def flush(self, writer):
+        """Отдаем накопленные записи потоку записи одним INSERT, не дожидаясь коммита"""
+        if not self._buffer:
+            return
+        entries, self._buffer = self._buffer, []
+        future = writer.submit(lambda local_session: local_session.execute(insert(SyncLog.__table__), entries))
+        future.add_done_callback(self._report_error)
+
+    @staticmethod
+    def _report_error(future):
+        if future.exception():
+            print(f"❌ Error logging sync: {future.exception()}")
+
+    def compact_if_due(self, writer):
+        """Раз в SYNC_LOG_COMPACT_INTERVAL_HOURS сворачиваем записи старше срока хранения в сводку по дням"""
+        now = datetime.utcnow()
+        if self._last_compaction and now - self._last_compaction < timedelta(hours=SYNC_LOG_COMPACT_INTERVAL_HOURS):
+            return
+        self._last_compaction = now
+        try:
+            removed = writer.run(lambda local_session: self._compact(local_session, now))
+            if removed:
+                print(f"🧹 Compacted {removed} sync log entries older than {SYNC_LOG_RETENTION_DAYS} days")
+        except Exception as e:
+            print(f"❌ Error compacting sync log: {e}")
+
+    def _compact(self, local_session: Session, now: datetime) -> int:
+        cutoff = now - timedelta(days=SYNC_LOG_RETENTION_DAYS)
+        log = SyncLog.__table__
+        summary = sqlite_insert(SyncLogSummary.__table__).from_select(
+            ["day", "table_name", "action", "count"],
+            select(func.date(log.c.sync_timestamp), log.c.table_name, log.c.action, func.count())
+            .where(log.c.sync_timestamp < cutoff)
+            .group_by(func.date(log.c.sync_timestamp), log.c.table_name, log.c.action)
+        )
+        summary = summary.on_conflict_do_update(
+            index_elements=["day", "table_name", "action"],
+            set_={"count": SyncLogSummary.__table__.c.count + summary.excluded.count}
+        )
+        local_session.execute(summary)
+        return local_session.execute(delete(log).where(log.c.sync_timestamp < cutoff)).rowcount
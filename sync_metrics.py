@@ -0,0 +1,111 @@
+import copy
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from database import db_manager
+
+# Сколько последних циклов хранить
+METRICS_HISTORY_SIZE = 20
+
+
+class SyncMetrics:
+    """Метрики циклов синхронизации: время фаз, строки, обращения к Supabase, трафик, ошибки"""
+
+    def __init__(self, history_size: int = METRICS_HISTORY_SIZE):
+        self._lock = threading.Lock()
+        self._current = None # Текущий цикл
+        self._started = None # perf_counter начала текущего цикла
+        self.history = deque(maxlen=history_size) # Завершенные циклы
+        self.totals = self._empty_counters() # Накопительно с запуска
+
+    def start_cycle(self):
+        with self._lock:
+            self._current = {
+                "started_at": datetime.utcnow(),
+                "finished_at": None,
+                "duration": None,
+                "phases": {}, # Секунды по фазам: push.task, fetch.task, pull.task ...
+                **self._empty_counters(),
+            }
+            self._started = time.perf_counter()
+
+    def finish_cycle(self, errors: int, backlog: dict):
+        with self._lock:
+            if self._current is None:
+                return
+            cycle = self._current
+            cycle["finished_at"] = datetime.utcnow()
+            cycle["duration"] = round(time.perf_counter() - self._started, 3) if self._started is not None else None
+            self._started = None
+            cycle["errors"] += errors
+            cycle["backlog"] = backlog
+            self.totals["errors"] += errors
+            self.totals["cycles"] += 1
+            self.history.append(cycle)
+            self._current = None
+
+    @contextmanager
+    def phase(self, name: str):
+        """Замер времени фазы текущего цикла"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                if self._current is not None:
+                    phases = self._current["phases"]
+                    phases[name] = round(phases.get(name, 0) + elapsed, 3)
+
+    def add(self, counter: str, value: int = 1, table_name: str = None):
+        """Увеличиваем счетчик (для rows_pushed/rows_pulled/conflicts — по таблице)"""
+        with self._lock:
+            for counters in (self._current, self.totals):
+                if counters is None:
+                    continue
+                if table_name is None:
+                    counters[counter] += value
+                else:
+                    counters[counter][table_name] = counters[counter].get(table_name, 0) + value
+
+    def snapshot(self) -> dict:
+        # Глубокая копия под блокировкой: вложенные phases и rows_* меняются потоком синхронизации
+        with self._lock:
+            return copy.deepcopy({
+                "current_cycle": self._current,
+                "last_cycle": self.history[-1] if self.history else None,
+                "totals": self.totals,
+                "history": list(self.history),
+            })
+
+    @staticmethod
+    def _empty_counters() -> dict:
+        return {
+            "rows_pushed": {},
+            "rows_pulled": {},
+            "conflicts": {},
+            "round_trips": 0,
+            "bytes_sent": 0, # Оценка: текст запросов и параметры
+            "bytes_received": 0, # Оценка: размер полученных значений
+            "errors": 0,
+            "cycles": 0,
+        }
+
+
+def estimate_size(rows) -> int:
+    """Примерный объем полученных строк в байтах"""
+    return sum(len(str(value)) for row in rows for value in row.values())
+
+
+sync_metrics = SyncMetrics()
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _count_remote_round_trip(conn, cursor, statement, parameters, context, executemany):
+    if db_manager.remote_engine is not None and conn.engine is db_manager.remote_engine:
+        sync_metrics.add("round_trips")
+        sync_metrics.add("bytes_sent", len(statement) + len(repr(parameters)))
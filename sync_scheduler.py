@@ -0,0 +1,127 @@
+import asyncio
+import os
+from database import db_manager
+from outbox import add_commit_listener
+
+# Интервал синхронизации без локальных изменений (секунды)
+SYNC_INTERVAL = float(os.getenv("SYNC_INTERVAL", "60"))
+# Пауза после последнего локального изменения перед синхронизацией
+SYNC_DEBOUNCE = float(os.getenv("SYNC_DEBOUNCE", "2"))
+# Максимальная задержка синхронизации при непрерывных изменениях
+SYNC_DEBOUNCE_MAX = float(os.getenv("SYNC_DEBOUNCE_MAX", "10"))
+# Экспоненциальная пауза после неудачной синхронизации
+SYNC_BACKOFF_BASE = float(os.getenv("SYNC_BACKOFF_BASE", "5"))
+SYNC_BACKOFF_MAX = float(os.getenv("SYNC_BACKOFF_MAX", "300"))
+# Проверка подключения к Supabase: интервал в онлайне и максимальная пауза в оффлайне
+PROBE_INTERVAL = float(os.getenv("SYNC_PROBE_INTERVAL", "60"))
+PROBE_BACKOFF_MAX = float(os.getenv("SYNC_PROBE_BACKOFF_MAX", "300"))
+
+
+class SyncScheduler:
+    """Планировщик синхронизации: запускает её вскоре после локальных изменений,
+    увеличивает паузу при ошибках и следит за подключением к Supabase"""
+
+    def __init__(self, service):
+        self.service = service
+        self.failures = 0 # Неудачных синхронизаций подряд
+        self._loop = None
+        self._wakeup = None # Есть локальные изменения или появилась сеть
+        self._probe_now = None # Нужно проверить подключение вне расписания
+        self._probe_task = None # Задача проверки подключения: event loop держит на задачи только слабые ссылки
+
+    async def run(self):
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._probe_now = asyncio.Event()
+        add_commit_listener(self.notify_local_write)
+        self._probe_task = asyncio.create_task(self._probe_loop())
+        self._wakeup.set() # Первая синхронизация сразу после запуска
+
+        try:
+            await self._sync_loop()
+        finally:
+            self.stop()
+
+    def stop(self):
+        """Останавливаем проверку подключения (при остановке приложения)"""
+        if self._probe_task:
+            self._probe_task.cancel()
+            self._probe_task = None
+
+    async def _sync_loop(self):
+        while True:
+            try:
+                if self.failures:
+                    # После ошибки локальные изменения не ускоряют повтор
+                    await asyncio.sleep(self._backoff(self.failures, SYNC_BACKOFF_BASE, SYNC_BACKOFF_MAX))
+                elif await self._wait(self._wakeup, SYNC_INTERVAL):
+                    await self._debounce()
+
+                if not db_manager.remote_ready:
+                    self.failures = 0
+                    continue
+
+                future, _ = self.service.request_sync()
+                if await asyncio.wrap_future(future):
+                    self.failures = 0
+                else:
+                    self._on_failure()
+            except Exception as e:
+                print(f"Sync error: {e}")
+                self._on_failure()
+
+    def notify_local_write(self):
+        """Вызывается после коммита локальных изменений (из любого потока)"""
+        if self._loop and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    async def _debounce(self):
+        """Ждем паузу в потоке изменений, но не дольше SYNC_DEBOUNCE_MAX"""
+        deadline = self._loop.time() + SYNC_DEBOUNCE_MAX
+        while True:
+            remaining = deadline - self._loop.time()
+            if remaining <= 0 or not await self._wait(self._wakeup, min(SYNC_DEBOUNCE, remaining)):
+                return
+
+    def _on_failure(self):
+        self.failures += 1
+        # Возможно, пропала сеть — проверяем подключение сразу
+        self._probe_now.set()
+
+    async def _probe_loop(self):
+        offline_probes = 0
+        while True:
+            was_ready = db_manager.remote_ready
+            try:
+                online = await asyncio.to_thread(db_manager.probe_remote)
+            except Exception as e:
+                # Ошибка проверки не должна останавливать повторные проверки
+                print(f"Probe error: {e}")
+                online = False
+
+            if online:
+                offline_probes = 0
+                delay = PROBE_INTERVAL
+                if db_manager.remote_ready and not was_ready:
+                    # Сеть вернулась (или схема готова) — синхронизируемся сразу
+                    self.failures = 0
+                    self._wakeup.set()
+            else:
+                offline_probes += 1
+                delay = self._backoff(offline_probes, SYNC_BACKOFF_BASE, PROBE_BACKOFF_MAX)
+
+            await self._wait(self._probe_now, delay)
+
+    async def _wait(self, event: asyncio.Event, timeout: float) -> bool:
+        """Ждем событие не дольше timeout; True — событие произошло"""
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            event.clear()
+
+    @staticmethod
+    def _backoff(attempt: int, base: float, limit: float) -> float:
+        return min(base * 2 ** (attempt - 1), limit)
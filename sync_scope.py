@@ -0,0 +1,48 @@
+import os
+from sqlalchemy import select
+from models import Company
+
+
+def _parse(value: str) -> frozenset:
+    return frozenset(item.strip() for item in (value or "").split(",") if item.strip())
+
+
+# Область репликации: supabase_id компаний через запятую. Пусто — все компании Supabase
+SYNC_COMPANY_SCOPE = _parse(os.getenv("SYNC_COMPANY_SCOPE", ""))
+
+
+class ReplicationScope:
+    """Компании, данные которых узел получает из Supabase и отправляет в нее
+
+    Фильтр применяется в запросах к Supabase: записи других компаний не выгружаются
+    и не могут быть перезаписаны этим узлом
+    """
+
+    def __init__(self, companies=SYNC_COMPANY_SCOPE):
+        self.companies = frozenset(companies)
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.companies)
+
+    def key(self):
+        """Область в виде строки для курсора (None — все компании)"""
+        return ",".join(sorted(self.companies)) or None
+
+    def widens(self, stored_key) -> bool:
+        """Область шире той, с которой загружались изменения: курсор нужно начать сначала"""
+        if not self.enabled:
+            return stored_key is not None
+        return stored_key is not None and not self.companies <= _parse(stored_key)
+
+    def allows(self, company_supabase_id) -> bool:
+        return not self.enabled or company_supabase_id in self.companies
+
+    def guard(self, table):
+        """Условие на строки таблицы Supabase внутри области (None — без ограничений)"""
+        if not self.enabled:
+            return None
+        companies = sorted(self.companies)
+        if table.name == "company":
+            return table.c.supabase_id.in_(companies)
+        return table.c.company_id.in_(select(Company.id).where(Company.supabase_id.in_(companies)))
@@ -1,429 +1,1327 @@
-import asyncio
+import json
+import queue
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from sqlmodel import Session, select
-from database import db_manager
-from models import Task, User, SyncLog, Company
-from datetime import datetime
-from sqlalchemy import text
+from database import db_manager, LOCAL_SHARDING
+from models import Task, TaskArchive, TaskHistory, User, Company, SyncCursor, SyncOutbox, SyncPullFailure
+from sync_id_map import IdMap
+from outbox import OUTBOX_TABLES, base_value
+from sync_scheduler import SyncScheduler
+from sync_metrics import sync_metrics, estimate_size
+from sync_log import SyncLogWriter
+from task_archive import TaskArchiver
+from sync_scope import ReplicationScope
+from company_revision import bump
+from change_feed import ChangeFeedPruner, record_changes
+from sync_snapshot import SYNC_BOOTSTRAP, export_snapshot, read_snapshot
+from datetime import datetime, timedelta
+from sqlalchemy import func, insert, update, delete, exists, literal, case, bindparam
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import OperationalError, InterfaceError, TimeoutError as PoolTimeoutError
+import os
+
+# Размер пачки при отправке изменений из outbox в Supabase
+SYNC_PUSH_BATCH_SIZE = int(os.getenv("SYNC_PUSH_BATCH_SIZE", "500"))
+# Размер порции строк при получении изменений из Supabase (курсор на стороне сервера)
+SYNC_PULL_PAGE_SIZE = int(os.getenv("SYNC_PULL_PAGE_SIZE", "500"))
+# Окно перед курсором, которое перечитывается при выгрузке (секунды): updated_at выдается
+# в начале транзакции Supabase, и строка, зафиксированная позже, может оказаться позади курсора.
+# Окно перечитывается, пока полная выгрузка не начнется позже курсора больше чем на это время
+SYNC_PULL_OVERLAP_SECONDS = int(os.getenv("SYNC_PULL_OVERLAP_SECONDS", "60"))
+# Сколько загруженных страниц может ждать применения (на таблицу)
+SYNC_PIPELINE_DEPTH = int(os.getenv("SYNC_PIPELINE_DEPTH", "4"))
+# После стольких неудачных попыток запись outbox откладывается и больше не отправляется
+SYNC_PUSH_MAX_ATTEMPTS = int(os.getenv("SYNC_PUSH_MAX_ATTEMPTS", "5"))
+# Отложенная запись из Supabase загружается повторно, пока неудачных попыток меньше этого числа
+SYNC_PULL_MAX_ATTEMPTS = int(os.getenv("SYNC_PULL_MAX_ATTEMPTS", "5"))
+
+# Порядок применения изменений из Supabase (по зависимостям внешних ключей)
+PULL_ORDER = ("company", "user", "task")
+PULL_MODELS = {"company": Company, "user": User, "task": Task}
+
+# Признак конца очереди страниц
+END_OF_CHANGES = object()
+
+# Запись в outbox без списка полей (создание, удаление): считаем измененными все поля
+ALL_FIELDS = "*"
+
+# Ошибки соединения с Supabase: отправка таблицы прерывается до следующего цикла.
+# Остальные ошибки относятся к данным конкретных записей
+CONNECTION_ERRORS = (OperationalError, InterfaceError, PoolTimeoutError)
 
 class SimpleSyncService:
+    def __init__(self):
+        self.id_map = IdMap() # Соответствие id между локальной базой и Supabase
+        self._outbox_backfilled = False # Записи, созданные до появления outbox, уже поставлены в очередь
+        self._cycle_errors = 0 # Ошибки текущего цикла синхронизации
+        self.scheduler = SyncScheduler(self)
+        self.metrics = sync_metrics
+        self.sync_log = SyncLogWriter() # Лог синхронизации пишется пачками в конце фаз
+        self.archiver = TaskArchiver() # Перенос старых выполненных и удаленных задач в архив
+        self.scope = ReplicationScope() # Компании, которые реплицирует узел
+        self.feed_pruner = ChangeFeedPruner() # Очистка ленты изменений для клиентов API
+        self._parked = {} # Отложенные записи выгрузки: таблица -> {supabase_id: неудачных попыток}
+        self._retry_ids = {} # Отложенные записи, которые еще нужно повторить в этом цикле: таблица -> {supabase_id}
+
+        # Синхронизация блокирующая, поэтому выполняется в отдельном потоке, а не в event loop
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sync")
+        # Потоки загрузки изменений из Supabase (по одному на таблицу)
+        self._fetch_executor = ThreadPoolExecutor(max_workers=len(PULL_ORDER), thread_name_prefix="sync-fetch")
+        self._lock = threading.Lock()
+        self._current = None # Future текущего запуска
+        self._status = {
+            "running": False,
+            "runs": 0,
+            "last_started": None,
+            "last_finished": None,
+            "last_error": None,
+        }
+
     async def start_sync(self):
-        """Фоновая синхронизация каждые 60 секунд"""
-        while True:
-            try:
-                if db_manager.is_online:
-                    self.sync_data()
-                await asyncio.sleep(60)
-            except Exception as e:
-                print(f"Sync error: {e}")
-                await asyncio.sleep(30)
+        """Фоновая синхронизация: после локальных изменений и по расписанию"""
+        await self.scheduler.run()
+
+    def request_sync(self):
+        """Запуск синхронизации в потоке синхронизации
+
+        Если синхронизация уже идет, новый запуск не создается — возвращается текущий.
+        Возвращает (future, started)
+        """
+        with self._lock:
+            if self._current and not self._current.done():
+                return self._current, False
+            self._current = self._executor.submit(self._run_sync)
+            return self._current, True
+
+    def get_status(self) -> dict:
+        """Состояние потока синхронизации"""
+        with self._lock:
+            return dict(self._status)
+
+    def shutdown(self):
+        self.scheduler.stop()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self._fetch_executor.shutdown(wait=False, cancel_futures=True)
+
+    def _run_sync(self):
+        with self._lock:
+            self._status["running"] = True
+            self._status["last_started"] = datetime.utcnow()
+        error = None
+        try:
+            if not self.sync_data():
+                error = f"Синхронизация завершилась с ошибками: {self._cycle_errors}"
+            return error is None
+        except Exception as e:
+            error = str(e)
+            raise
+        finally:
+            with self._lock:
+                self._status["running"] = False
+                self._status["runs"] += 1
+                self._status["last_finished"] = datetime.utcnow()
+                self._status["last_error"] = error
     
-    def sync_data(self):
-        """Основная логика синхронизации"""
+    def sync_data(self) -> bool:
+        """Основная логика синхронизации, возвращает True, если цикл прошел без ошибок"""
         print("🔄 Starting sync...")
-        
-        # Синхронизируем в правильном порядке
-        self._sync_companies() # Компании
-        self._sync_users()    # Пользователи
-        self._sync_tasks()    # Задачи
-        
+        self._cycle_errors = 0
+        self.metrics.start_cycle()
+        try:
+            self._sync_cycle()
+        finally:
+            self.metrics.finish_cycle(self._cycle_errors, self.get_backlog())
 
         print("✅ Sync completed")
-    
-    def _sync_companies(self):
-        # Синхронизация компаний
+        return self._cycle_errors == 0
+
+    def _sync_cycle(self):
+        if not self._outbox_backfilled:
+            self._backfill_outbox()
+
+        # Соответствия id загружаем один раз за цикл
+        self.id_map = IdMap()
+        with Session(db_manager.local_engine) as local_session:
+            self.id_map.load(local_session)
+        
+        # 1. Отправляем локальные изменения в правильном порядке: компании → пользователи → задачи
+        self._push_all()
+
+        # 2. Получаем изменения из Supabase конвейером
+        self._pull_all()
+
+        self.sync_log.compact_if_due(db_manager.get_writer())
+        self.feed_pruner.prune_if_due([db_manager.get_writer(engine) for engine in db_manager.task_engines()])
+
+        # Архивируем после обмена: неотправленные изменения к этому моменту уже ушли
+        if self.archiver.is_due():
+            for engine in db_manager.task_engines():
+                self.archiver.archive(db_manager.get_writer(engine))
+
+    def get_backlog(self) -> dict:
+        """Неотправленные изменения в outbox: количество по таблицам и возраст самого старого"""
+        tables = {}
+        oldest = None
+        parked = 0
+        try:
+            # В режиме шардов outbox задач лежит в файлах компаний
+            for engine in db_manager.task_engines():
+                with Session(engine) as local_session:
+                    counts = local_session.exec(
+                        select(SyncOutbox.table_name, func.count(SyncOutbox.id)).group_by(SyncOutbox.table_name)
+                    ).all()
+                    first = local_session.exec(select(func.min(SyncOutbox.created_at))).one()
+                    parked += local_session.exec(
+                        select(func.count(SyncOutbox.id)).where(SyncOutbox.attempts >= SYNC_PUSH_MAX_ATTEMPTS)
+                    ).one()
+                for table_name, count in counts:
+                    tables[table_name] = tables.get(table_name, 0) + count
+                if first and (oldest is None or first < oldest):
+                    oldest = first
+            with Session(db_manager.local_engine) as local_session:
+                parked_pulls = local_session.exec(select(func.count()).select_from(SyncPullFailure)).one()
+        except Exception as e:
+            print(f"❌ Error reading sync backlog: {e}")
+            return {}
+        return {
+            "total": sum(tables.values()),
+            "tables": tables,
+            "parked": parked,
+            "parked_pulls": parked_pulls,
+            "oldest_age_seconds": round((datetime.utcnow() - oldest).total_seconds(), 1) if oldest else 0,
+        }
+
+    def get_stats(self) -> dict:
+        """Метрики синхронизации для /sync/stats"""
+        return {
+            "status": self.get_status(),
+            "backlog": self.get_backlog(),
+            "local_writes": db_manager.get_writer().snapshot() if db_manager.writers else {},
+            **self.metrics.snapshot(),
+        }
+
+    def _push_all(self):
+        """Отправка изменений из outbox в Supabase"""
+        if not db_manager.remote_ready:
+            # Схема Supabase еще мигрирует (или миграция не удалась): без нее записи outbox отложились бы как ошибочные
+            return
         remote_session = db_manager.get_remote_session()
         if not remote_session:
             return
 
         try:
-            with Session(db_manager.local_engine) as local_session:
-                # 1. Отправляем локальные компании в Supabase
-                local_companies = local_session.exec(select(Company).where(Company.is_synced == False)).all()
-                print(f"📤 Syncing {len(local_companies)} companies to Supabase...")
-
-                for company in local_companies:
-                    try:
-                        # Проверяем, есть ли компания уже в Supabase
-                        existing_company = None
-                        if company.supabase_id:
-                            existing_company = remote_session.exec(select(Company).where(Company.supabase_id == company.supabase_id)).first()
-                            
-                        if existing_company:
-                            # Обновляем существующую компанию
-                            existing_company.title = company.title
-                            existing_company.description = company.description
-                            existing_company.updated_at = datetime.utcnow()
-                            remote_company = existing_company
-
-                        else:
-                            # Создаем новую компанию в Supabase
-                            remote_company = Company(
-                                title=company.title,
-                                description=company.description,
-                                supabase_id=company.supabase_id or f"local_company_{company.id}",
-                                created_at=company.created_at,
-                                updated_at=company.updated_at
-                            )
-                            remote_session.add(remote_company)
-
-                        remote_session.commit()
-                        remote_session.refresh(remote_company)
-
-                        if not company.supabase_id:
-                            company.supabase_id = remote_company.supabase_id
-                        
-                        company.is_synced = True
-                        company.updated_at = datetime.utcnow()
-                        local_session.commit()
-
-                        self._log_sync("UPDATE" if existing_company else "CREATE", "company", company.id, company.supabase_id)
-                    
-                    except Exception as e:
-                        print(f"❌ Error syncing company {company.id}: {e}")
-                        remote_session.rollback()
-
-                # 2. Получаем компании из Supabase
-                remote_companies = remote_session.exec(select(Company)).all()
-
-                print(f"📥 Syncing {len(remote_companies)} companies from Supabase...")
-
-                for remote_company in remote_companies:
-                    try:
-                        # Проверяем, есть ли компания в локальной БД
-                        local_company = local_session.exec(select(Company).where(Company.supabase_id == remote_company.supabase_id)).first()
-
-                        if not local_company:
-                            # Добавляем новую компанию в локальную БД
-                            new_company = Company(
-                                title=remote_company.title,
-                                description=remote_company.description,
-                                supabase_id=remote_company.supabase_id,
-                                is_synced=True,
-                                created_at=remote_company.created_at,
-                                updated_at=remote_company.updated_at
-                            )
-                            local_session.add(new_company)
-                            local_session.commit()
-
-                            self._log_sync("CREATE", "company", new_company.id, remote_company.supabase_id)
-                    
-                    except Exception as e:
-                        print(f"❌ Error processing remote company {remote_company.id}: {e}")
-                        local_session.rollback()
+            with db_manager.get_sync_session() as local_session:
+                self._drain_outbox(local_session, remote_session, Company, "company", {},
+                                   lambda company: {
+                                       "title": company.title,
+                                       "description": company.description,
+                                       "supabase_id": company.supabase_id,
+                                       "is_deleted": company.is_deleted,
+                                       "created_at": company.created_at,
+                                       "edited_at": company.edited_at,
+                                   })
 
+                self._drain_outbox(local_session, remote_session, User, "user",
+                                   {"company": "company_id"},
+                                   lambda user: {
+                                       "user_name": user.user_name,
+                                       "email": user.email,
+                                       "password": user.password,
+                                       "phone": user.phone,
+                                       "telegram": user.telegram,
+                                       "status": user.status,
+                                       "company_id": self._remote_company_id(user.company_id),
+                                       "supabase_id": user.supabase_id,
+                                       "is_deleted": user.is_deleted,
+                                       "created_at": user.created_at,
+                                       "edited_at": user.edited_at,
+                                   })
+
+            # Задачи: основная база и файлы компаний (в режиме шардов)
+            for engine in db_manager.task_engines():
+                with db_manager.get_sync_session(engine) as local_session:
+                    self._drain_outbox(local_session, remote_session, Task, "task",
+                                       {"company": "company_id", "user": "assignee_id"},
+                                       lambda task: {
+                                           "title": task.title,
+                                           "description": task.description,
+                                           "assignee_id": self._remote_user_id(task.assignee_id),
+                                           "company_id": self._remote_company_id(task.company_id),
+                                           "due_date": task.due_date,
+                                           "priority": task.priority,
+                                           "status": task.status,
+                                           "supabase_id": task.supabase_id,
+                                           "is_synced": True,
+                                           "is_deleted": task.is_deleted,
+                                           "created_at": task.created_at,
+                                           "edited_at": task.edited_at,
+                                       })
         except Exception as e:
-            print(f"❌ Company sync error: {e}")
+            print(f"❌ Push error: {e}")
+            self._cycle_errors += 1
         finally:
             remote_session.close()
 
+    def _pull_all(self):
+        """Получение изменений из Supabase
 
-    def _sync_users(self):
-        """Синхронизация пользователей"""
-        remote_session = db_manager.get_remote_session()
-        if not remote_session:
+        Загрузка из Supabase идет параллельно по таблицам, страницы передаются через
+        ограниченные очереди, а применяются к локальной базе в порядке зависимостей:
+        компании → пользователи → задачи. Пока применяются компании, пользователи
+        и задачи уже загружаются.
+        """
+        if not db_manager.remote_engine or not db_manager.remote_ready:
             return
-            
+
+        if SYNC_BOOTSTRAP == "snapshot" and self._needs_bootstrap():
+            self._bootstrap_snapshot()
+
+        with db_manager.get_sync_session() as local_session:
+            cursors = {table_name: self._get_cursor(local_session, table_name) for table_name in PULL_ORDER}
+            for cursor in cursors.values():
+                if cursor.last_updated_at is not None and self.scope.widens(cursor.scope):
+                    # В область добавлены компании: загружаем таблицу сначала, включая удаленные записи
+                    print(f"🔭 Replication scope widened, re-pulling {cursor.table_name}")
+                    cursor.last_updated_at, cursor.last_remote_id, cursor.settled_at = datetime.min, 0, None
+            positions = {
+                table_name: (cursor.last_updated_at, cursor.last_remote_id, cursor.settled_at)
+                for table_name, cursor in cursors.items()
+            }
+            self._parked, self._retry_ids = {}, {}
+            for table_name, supabase_id, attempts in local_session.exec(
+                select(SyncPullFailure.table_name, SyncPullFailure.supabase_id, SyncPullFailure.attempts)
+            ):
+                self._parked.setdefault(table_name, {})[supabase_id] = attempts
+                if attempts < SYNC_PULL_MAX_ATTEMPTS:
+                    self._retry_ids.setdefault(table_name, set()).add(supabase_id)
+
+        # Время Supabase до начала загрузки: записи старше него на окно к этому моменту зафиксированы
+        pulled_at = self._remote_time()
+
+        stop = threading.Event()
+        pages = {table_name: queue.Queue(maxsize=SYNC_PIPELINE_DEPTH) for table_name in PULL_ORDER}
+        fetchers = [
+            self._fetch_executor.submit(self._fetch_changes, table_name, positions[table_name], pages[table_name], stop)
+            for table_name in PULL_ORDER
+        ]
+
         try:
-            with Session(db_manager.local_engine) as local_session:
-                # 1. Отправляем локальных пользователей в Supabase
-                local_users = local_session.exec(
-                    select(User).where(User.is_synced == False)).all()
-                
-                print(f"📤 Syncing {len(local_users)} users to Supabase...")
-                
-                for user in local_users:
-                    try:
-                        # Находим соответсвующую компанию в Supabase
-                        remote_company_id = None
-                        if user.company_id:
-                            local_company = local_session.exec(select(Company).where(Company.id == user.company_id)).first()
-
-                            if local_company and local_company.supabase_id:
-                                remote_company = remote_session.exec(select(Company).where(Company.supabase_id == local_company.supabase_id)).first()
-
-                                if remote_company:
-                                    remote_company_id = remote_company.id
-                                else:
-                                    print(f"    ⚠️ No remote company found for supabase_id: {local_company.supabase_id}")
-                
-                        # Проверяем, есть ли пользователь уже в Supabase
-                        existing_user = None
-                        if user.supabase_id:
-                            existing_user = remote_session.exec(select(User).where(User.supabase_id == user.supabase_id)).first()
-                        
-                        if existing_user:
-                            # Обновляем существующего пользователя
-                            existing_user.user_name = user.user_name
-                            existing_user.email = user.email
-                            existing_user.password = user.password
-                            existing_user.phone = user.phone
-                            existing_user.telegram = user.telegram
-                            existing_user.status = user.status
-                            existing_user.company_id = remote_company_id
-                            existing_user.updated_at = datetime.utcnow()
-                            remote_user= existing_user
-                        else:
-                            # Создаем нового пользователя в Supabase
-                            remote_user = User(
-                                user_name=user.user_name,
-                                email=user.email,
-                                password = user.password,
-                                phone=user.phone,
-                                telegram=user.telegram,
-                                status=user.status,
-                                company_id=remote_company_id,
-                                supabase_id=user.supabase_id or f"local_{user.id}",  # ← СОЗДАЕМ УНИКАЛЬНЫЙ ID
-                                created_at=user.created_at,
-                                updated_at=user.updated_at
-                            )
-                            remote_session.add(remote_user)
-                        
-                        remote_session.commit()
-                        remote_session.refresh(remote_user)  # ← ПОЛУЧАЕМ НОВЫЙ ID
-                        
-                        # СОХРАНЯЕМ СООТВЕТСТВИЕ ID
-                        if not user.supabase_id:
-                            user.supabase_id = remote_user.supabase_id
-                        
-                        # Помечаем как синхронизированного
-                        user.is_synced = True
-                        user.updated_at = datetime.utcnow()
-                        local_session.commit()
-                        
-                        self._log_sync("UPDATE" if existing_user else "CREATE", "user", user.id, user.supabase_id)
-                        
-                    except Exception as e:
-                        print(f"❌ Error syncing user {user.id}: {e}")
-                        remote_session.rollback()
-                
-                # 2. Получаем пользователей из Supabase
-                remote_users = remote_session.exec(select(User)).all()
-                
-                print(f"📥 Syncing {len(remote_users)} users from Supabase...")
-                
-                for remote_user in remote_users:
-                    try:
-                        # Находим соответствующую компанию в локальной базе
-                        local_company_id = None
-                        if remote_user.company_id:
-                            remote_company = remote_session.exec(select(Company).where(Company.id == remote_user.company_id)).first()
-
-                            if remote_company and remote_company.supabase_id:
-                                local_company = local_session.exec(select(Company).where(Company.supabase_id == remote_company.supabase_id)).first()
-
-                                if local_company:
-                                    local_company_id = local_company.id
-
-                        # Проверяем, есть ли пользователь в локальной БД
-                        local_user = local_session.exec(
-                            select(User).where(User.supabase_id == remote_user.supabase_id)).first()
-                        
-                        if not local_user:
-                            # Добавляем нового пользователя в локальную БД
-                            new_user = User(
-                                user_name=remote_user.user_name,
-                                email=remote_user.email,
-                                password = remote_user.password,
-                                phone=remote_user.phone,
-                                telegram=remote_user.telegram,
-                                status=remote_user.status,
-                                company_id=local_company_id,
-                                supabase_id=remote_user.supabase_id,
-                                is_synced=True,
-                                created_at=remote_user.created_at,
-                                updated_at=remote_user.updated_at
-                            )
-                            local_session.add(new_user)
-                            local_session.commit()
-                            
-                            self._log_sync("CREATE", "user", new_user.id, remote_user.supabase_id)
-                        
-                    except Exception as e:
-                        print(f"    ❌ Error processing remote user {remote_user.id}: {e}")
-    
+            for table_name in PULL_ORDER:
+                if not self._apply_changes(table_name, cursors[table_name], pages[table_name], pulled_at):
+                    # Загрузка прервалась, а следующие таблицы ссылаются на эту: применим их, когда она догрузится
+                    print(f"⏭️ {table_name} changes are incomplete, skipping dependent tables until the next sync")
+                    break
         except Exception as e:
-            print(f"❌ User sync error: {e}")
+            print(f"❌ Pull error: {e}")
+            self._cycle_errors += 1
         finally:
-            remote_session.close()
-    
-    def _sync_tasks(self):
-        """Синхронизация задач"""
+            # Останавливаем загрузку, если применение прервалось
+            stop.set()
+            for future in fetchers:
+                future.result()
+
+    def _needs_bootstrap(self) -> bool:
+        """Новый узел: из Supabase еще ничего не загружалось и локальных данных нет"""
+        with db_manager.get_sync_session() as local_session:
+            return (
+                local_session.exec(select(SyncCursor.table_name).limit(1)).first() is None
+                and local_session.exec(select(Company.id).limit(1)).first() is None
+                and local_session.exec(select(User.id).limit(1)).first() is None
+            )
+
+    def _bootstrap_snapshot(self):
+        """Первая загрузка снимком: сжатая выгрузка таблиц и пакетная вставка
+
+        Компании и пользователи (и задачи без шардов) вставляются одной транзакцией основной базы,
+        задачи в режиме шардов — заданиями потоков записи файлов своих компаний. Курсор таблицы
+        встает на позицию снимка вместе с ее данными, дальше синхронизация идет инкрементально.
+        При ошибке недогруженные таблицы загрузит обычная выгрузка изменений
+        """
+        queries = {
+            table_name: (self._changed_since(table_name, (None, 0, None)).order_by(None), PULL_MODELS[table_name].__table__)
+            for table_name in PULL_ORDER
+        }
+        try:
+            with tempfile.TemporaryDirectory(prefix="sync-snapshot-") as directory:
+                with self.metrics.phase("bootstrap.export"):
+                    paths, positions = export_snapshot(db_manager.remote_engine, directory, queries)
+                for path in paths.values():
+                    self.metrics.add("bytes_received", os.path.getsize(path))
+
+                with self.metrics.phase("bootstrap.load"):
+                    tables = ("company", "user") if LOCAL_SHARDING else PULL_ORDER
+                    loaded = db_manager.get_writer().run(
+                        lambda local_session: self._load_snapshot(local_session, paths, positions, tables),
+                        skip_outbox=True
+                    )
+                    if LOCAL_SHARDING:
+                        loaded["task"] = self._load_snapshot_tasks(paths["task"])
+                        db_manager.get_writer().run(
+                            lambda local_session: self._save_positions(local_session, positions, ("task",)),
+                            skip_outbox=True
+                        )
+        except Exception as e:
+            print(f"⚠️ Snapshot bootstrap failed, falling back to incremental pull: {e}")
+            self.id_map = IdMap()
+            with Session(db_manager.local_engine) as local_session:
+                self.id_map.load(local_session)
+            return
+
+        for table_name, count in loaded.items():
+            self.metrics.add("rows_pulled", count, table_name)
+        print("📦 Bootstrapped from snapshot: " + ", ".join(f"{count} {table_name}" for table_name, count in loaded.items()))
+
+    def _load_snapshot(self, local_session: Session, paths: dict, positions: dict, tables) -> dict:
+        """Пакетная вставка таблиц снимка в задании потока записи основной базы
+
+        Возвращает количество строк по таблицам
+        """
+        loaded = {}
+        for table_name in tables:
+            loaded[table_name] = 0
+            for batch in read_snapshot(paths[table_name], PULL_MODELS[table_name].__table__):
+                rows, values, failed = self._snapshot_batch(table_name, batch)
+                self._insert_snapshot(local_session, table_name, rows, values)
+                self._park_rows(local_session, table_name, [], failed)
+                loaded[table_name] += len(rows)
+        self._save_positions(local_session, positions, tables)
+        self.id_map.flush(local_session)
+        return loaded
+
+    def _load_snapshot_tasks(self, path: str) -> int:
+        """Задачи снимка в режиме шардов: каждая пачка — заданиями потоков записи файлов компаний"""
+        loaded = 0
+        for batch in read_snapshot(path, Task.__table__):
+            rows, values, failed = self._snapshot_batch("task", batch)
+            targets = {}
+            for row, value in zip(rows, values):
+                target = targets.setdefault(self._row_engine("task", row), ([], []))
+                target[0].append(row)
+                target[1].append(value)
+            for engine, (engine_rows, engine_values) in targets.items():
+                db_manager.get_writer(engine).run(
+                    lambda local_session: self._insert_snapshot(local_session, "task", engine_rows, engine_values),
+                    skip_outbox=True
+                )
+            if failed:
+                db_manager.get_writer().run(
+                    lambda local_session: self._park_rows(local_session, "task", [], failed),
+                    skip_outbox=True
+                )
+            loaded += len(rows)
+        return loaded
+
+    def _snapshot_batch(self, table_name: str, batch: list):
+        """Пачка снимка → (строки, значения локальных записей, [(строка, ошибка)] отложенных строк)
+
+        Строки со ссылками на записи, которых нет локально, откладываются (SyncPullFailure),
+        как и при инкрементальной выгрузке, а не вставляются с пустыми внешними ключами
+        """
+        rows, values, failed = [], [], []
+        for row in batch:
+            value = self._snapshot_values(table_name, row)
+            unresolved = self._unresolved_references(row, value)
+            if unresolved:
+                print(f"    ❌ Error processing remote {table_name} {row['id']}, parking it: "
+                      f"unresolved references: {', '.join(unresolved)}")
+                failed.append((row, LookupError(f"unresolved references: {', '.join(unresolved)}")))
+                continue
+            rows.append(row)
+            values.append(value)
+        self._cycle_errors += len(failed)
+        return rows, values, failed
+
+    @staticmethod
+    def _unresolved_references(row: dict, values: dict) -> list:
+        """Внешние ключи, которые в Supabase заданы, а локально не нашлись"""
+        return [field for field, value in values.items() if value is None and row.get(field) is not None]
+
+    def _insert_snapshot(self, local_session: Session, table_name: str, rows: list, values: list):
+        """Одна пачка строк снимка: executemany, id_map, лента изменений и счетчики ETag файла"""
+        if not rows:
+            return
+        table = PULL_MODELS[table_name].__table__
+        connection = local_session.connection()
+        inserted = connection.execute(insert(table).returning(table.c.id, table.c.supabase_id), values).all()
+        if table_name in ("company", "user"):
+            remote_ids = {row["supabase_id"]: row["id"] for row in rows}
+            for local_id, supabase_id in inserted:
+                self.id_map.remember(table_name, supabase_id, local_id, remote_ids[supabase_id])
+        if table_name in ("user", "task"):
+            # Новые записи — в ленту изменений файла, куда они записаны
+            company_by_supabase = {value["supabase_id"]: value["company_id"] for value in values}
+            record_changes(connection, table_name, [
+                (local_id, company_by_supabase[supabase_id]) for local_id, supabase_id in inserted
+            ])
+        bump(local_session, [local_id for local_id, _ in inserted] if table_name == "company"
+             else {value["company_id"] for value in values})
+
+    def _save_positions(self, local_session: Session, positions: dict, tables):
+        """Курсоры таблиц встают на позиции снимка"""
+        for table_name in tables:
+            cursor = self._get_cursor(local_session, table_name)
+            cursor.last_updated_at, cursor.last_remote_id = positions[table_name]
+            cursor.settled_at = None
+            cursor.scope = self.scope.key()
+            local_session.add(cursor)
+
+    def _snapshot_values(self, table_name: str, row: dict) -> dict:
+        """Строка снимка → значения локальной записи (внешние ключи через supabase_id)"""
+        values = {
+            "supabase_id": row["supabase_id"],
+            "is_synced": True,
+            "is_deleted": row["is_deleted"],
+            "version": row["version"],
+            "created_at": row["created_at"],
+            "updated_at": row["updated_at"],
+            "edited_at": row.get("edited_at"),
+        }
+        if table_name == "company":
+            values.update(title=row["title"], description=row["description"])
+        elif table_name == "user":
+            values.update(
+                user_name=row["user_name"],
+                email=row["email"],
+                password=row["password"],
+                phone=row["phone"],
+                telegram=row["telegram"],
+                status=row["status"],
+                company_id=self.id_map.local_id("company", row["company_supabase_id"]),
+            )
+        else:
+            values.update(
+                title=row["title"],
+                description=row["description"],
+                assignee_id=self.id_map.local_id("user", row["assignee_supabase_id"]),
+                company_id=self.id_map.local_id("company", row["company_supabase_id"]),
+                due_date=row["due_date"],
+                priority=row["priority"],
+                status=row["status"],
+            )
+        return values
+
+    def _fetch_changes(self, table_name: str, position, pages: queue.Queue, stop: threading.Event):
+        """Загрузка изменений таблицы из Supabase (выполняется в отдельном потоке)
+
+        Один запрос с курсором на стороне сервера: строки приходят порциями по SYNC_PULL_PAGE_SIZE
+        и сразу уходят в очередь применения. В памяти одновременно не больше SYNC_PIPELINE_DEPTH
+        порций, сколько бы строк ни было в Supabase
+        """
         remote_session = db_manager.get_remote_session()
+        result = None
+        try:
+            if not remote_session:
+                return
+            result = remote_session.execute(
+                self._changed_since(table_name, position)
+                .execution_options(stream_results=True, yield_per=SYNC_PULL_PAGE_SIZE)
+            ).mappings()
+            chunks = result.partitions()
+            while not stop.is_set():
+                with self.metrics.phase(f"fetch.{table_name}"):
+                    chunk = next(chunks, None)
+                if chunk is None:
+                    break
+                rows = [dict(row) for row in chunk]
+                self.metrics.add("bytes_received", estimate_size(rows))
+                self._put_page(pages, rows, stop)
+        except Exception as e:
+            self._put_page(pages, e, stop)
+        finally:
+            self._put_page(pages, END_OF_CHANGES, stop)
+            if result is not None:
+                # Закрываем курсор, если применение остановилось раньше
+                result.close()
+            if remote_session:
+                remote_session.close()
+
+    def _put_page(self, pages: queue.Queue, item, stop: threading.Event):
+        # Очередь ограничена: ждем, пока применение догонит загрузку, или остановки
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def _apply_changes(self, table_name: str, cursor: SyncCursor, pages: queue.Queue, pulled_at) -> bool:
+        """Применение страниц изменений к локальной базе по мере поступления
+
+        Возвращает True, если применены все изменения таблицы
+        """
+        with self.metrics.phase(f"pull.{table_name}"):
+            try:
+                if not self._apply_pages(table_name, cursor, pages):
+                    return False
+                self._settle_cursor(cursor, pulled_at)
+                self._retry_parked(table_name)
+                return True
+            finally:
+                self.sync_log.flush(db_manager.get_writer())
+
+    def _apply_pages(self, table_name: str, cursor: SyncCursor, pages: queue.Queue) -> bool:
+        apply_row = self._row_applier(table_name)
+        applied = 0
+        while True:
+            page = pages.get()
+            if page is END_OF_CHANGES:
+                print(f"📥 Synced {applied} {table_name} changes from Supabase")
+                return True
+            if isinstance(page, Exception):
+                print(f"❌ Error fetching {table_name} changes: {page}")
+                self._cycle_errors += 1
+                return False
+
+            processed = self._apply_page(table_name, apply_row, cursor, page)
+            applied += processed
+            self.metrics.add("rows_pulled", processed, table_name)
+
+    def _row_applier(self, table_name: str):
+        return {
+            "company": self._apply_remote_company,
+            "user": self._apply_remote_user,
+            "task": self._apply_remote_task,
+        }[table_name]
+
+    def _retry_parked(self, table_name: str):
+        """Повторная загрузка и применение отложенных записей таблицы (до SYNC_PULL_MAX_ATTEMPTS попыток)
+
+        Записи, уже загруженные в этом цикле обычной выгрузкой, не повторяются. Записи,
+        которых больше нет в Supabase или в области репликации, снимаются с учета
+        """
+        supabase_ids = sorted(self._retry_ids.pop(table_name, ()))
+        remote_session = db_manager.get_remote_session() if supabase_ids else None
         if not remote_session:
             return
-            
+        table = PULL_MODELS[table_name].__table__
         try:
-            with Session(db_manager.local_engine) as local_session:
-                # 1. Получаем непосинхронизированные задачи из локальной БД
-                local_tasks = local_session.exec(
-                    select(Task).where(Task.is_synced == False)
-                ).all()
-                
-                print(f"📤 Syncing {len(local_tasks)} tasks to Supabase...")
-                
-                
-                for task in local_tasks:
-                    try:
-                        # НАХОДИМ СООТВЕТСТВУЮЩЕГО ПОЛЬЗОВАТЕЛЯ В SUPABASE
-                        remote_assignee_id = None
-                        if task.assignee_id:
-                            local_user = local_session.exec(select(User).where(User.id == task.assignee_id)).first()
-                            
-                            if local_user and local_user.supabase_id:
-                                remote_user = remote_session.exec(
-                                    select(User).where(User.supabase_id == local_user.supabase_id)).first()
-                                
-                                if remote_user:
-                                    remote_assignee_id = remote_user.id
-                                else:
-                                    print(f"    ⚠️ No remote user found for supabase_id: {local_user.supabase_id}")
-                            else:
-                                print(f"    ⚠️ Local user {task.assignee_id} not found or has no supabase_id")
-                        
-                        # Находим соответсвующую компанию в Supabase
-                        remote_company_id = None
-                        if task.company_id:
-                            local_company = local_session.exec(select(Company).where(Company.id == task.company_id)).first()
-
-                            if local_company and local_company.supabase_id:
-                                remote_company = remote_session.exec(select(Company).where(Company.supabase_id == local_company.supabase_id)).first()
-
-                                if remote_company:
-                                    remote_company_id = remote_company.id
-                                else:
-                                    print(f"    ⚠️ No remote company found for supabase_id: {local_company.supabase_id}")
-                            
-                        # Проверяем, есть ли задача уже в Supabase
-                        existing_task = None
-                        if task.supabase_id:
-                            existing_task = remote_session.exec(
-                                select(Task).where(Task.supabase_id == task.supabase_id)).first()
-                        
-                        if existing_task:
-                            # Обновляем существующую задачу
-                            existing_task.title = task.title
-                            existing_task.description = task.description
-                            existing_task.assignee_id = remote_assignee_id
-                            existing_task.company_id = remote_company_id
-                            existing_task.due_date = task.due_date
-                            existing_task.priority = task.priority
-                            existing_task.status = task.status
-                            existing_task.updated_at = datetime.utcnow()
-                            remote_task = existing_task
-                        else:
-                            # Создаем новую задачу в Supabase
-                            remote_task = Task(
-                                title=task.title,
-                                description=task.description,
-                                assignee_id=remote_assignee_id,
-                                company_id=remote_company_id,
-                                due_date=task.due_date,
-                                priority=task.priority,
-                                status=task.status,
-                                supabase_id=task.supabase_id or f"local_task_{task.id}",
-                                is_synced=True,
-                                is_deleted=task.is_deleted,
-                                created_at=task.created_at,
-                                updated_at=task.updated_at
-                            )
-                            remote_session.add(remote_task)
-                        
-                        remote_session.commit()
-                        
-                        # Помечаем как синхронизированную
-                        task.is_synced = True
-                        task.updated_at = datetime.utcnow()
-                        local_session.commit()
-                        
-                        self._log_sync("UPDATE" if existing_task else "CREATE", "task", task.id, task.supabase_id)
-                        
-                    except Exception as e:
-                        print(f"    ❌ Error syncing task {task.id}: {e}")
-                        remote_session.rollback()
-                
-                # 2. Получаем задачи из Supabase для обновления локальной БД
-                remote_tasks = remote_session.exec(select(Task)).all()
-                
-                print(f"📥 Syncing {len(remote_tasks)} tasks from Supabase...")
-                
-                for remote_task in remote_tasks:
-                    try:
-                        # Находим соответсвующего пользователя в локальной базе
-                        local_assignee_id = None
-                        if remote_task.assignee_id:
-                            # Получаем пользователя из удаленной базы
-                            remote_user = remote_session.exec(
-                                select(User).where(User.id == remote_task.assignee_id)).first()
-                            
-                            if remote_user and remote_user.supabase_id:
-                                # Ищем пользователя в локальной базе по supabase_id
-                                local_user = local_session.exec(
-                                    select(User).where(User.supabase_id == remote_user.supabase_id)).first()
-                                
-                                if local_user:
-                                    local_assignee_id = local_user.id
-                        
-                        # Находим соответсвующую компанию в локальной базе
-                        local_company_id = None
-                        if remote_task.company_id:
-                            remote_company = remote_session.exec(select(Company).where(Company.id == remote_task.company_id)).first()
-
-                            if remote_company and remote_company.supabase_id:
-                                local_company = local_session.exec(select(Company).where(Company.supabase_id == remote_company.supabase_id)).first()
-
-                                if local_company:
-                                    local_company_id = local_company.id
-                        
-                        # Проверяем, есть ли задача в локальной БД
-                        local_task = local_session.exec(
-                            select(Task).where(Task.supabase_id == remote_task.supabase_id)).first()
-                        
-                        if not local_task:
-                            # Добавляем новую задачу в локальную БД
-                            new_task = Task(
-                                title=remote_task.title,
-                                description=remote_task.description,
-                                assignee_id=local_assignee_id,
-                                company_id=local_company_id,
-                                due_date=remote_task.due_date,
-                                priority=remote_task.priority,
-                                status=remote_task.status,
-                                supabase_id=remote_task.supabase_id,
-                                is_synced=True,
-                                is_deleted=remote_task.is_deleted,
-                                created_at=remote_task.created_at,
-                                updated_at=remote_task.updated_at
-                            )
-                            local_session.add(new_task)
-                            local_session.commit()
-                            
-                            
-                            self._log_sync("CREATE", "task", new_task.id, remote_task.supabase_id)
-                            
-                    except Exception as e:
-                        print(f"    ❌ Error processing remote task {remote_task.id}: {e}")
-                        
-        except Exception as e:
-            print(f"❌ Task sync error: {e}")
+            rows = [
+                dict(row) for row in
+                remote_session.execute(self._pull_query(table_name).where(table.c.supabase_id.in_(supabase_ids))).mappings()
+            ]
         finally:
             remote_session.close()
-                
-    
-    
-    def _log_sync(self, action: str, table_name: str, record_id: int, supabase_id: str = None):
-        """Логирование синхронизации"""
+        self.metrics.add("bytes_received", estimate_size(rows))
+
+        print(f"🔁 Retrying {len(supabase_ids)} parked {table_name} changes")
+        gone = set(supabase_ids) - {row["supabase_id"] for row in rows}
+        if gone:
+            def drop(local_session: Session):
+                local_session.execute(
+                    delete(SyncPullFailure.__table__)
+                    .where(SyncPullFailure.table_name == table_name)
+                    .where(SyncPullFailure.supabase_id.in_(gone))
+                )
+            db_manager.get_writer().run(drop, skip_outbox=True)
+            for supabase_id in gone:
+                self._parked[table_name].pop(supabase_id, None)
+        if rows:
+            processed = self._apply_page(table_name, self._row_applier(table_name), None, rows)
+            self.metrics.add("rows_pulled", processed, table_name)
+
+    def _apply_remote_company(self, local_session: Session, row: dict):
+        """Компания из Supabase → локальная база"""
+        return self._apply_remote(local_session, "company", row, {
+            "title": row["title"],
+            "description": row["description"],
+            "is_deleted": row["is_deleted"],
+        })
+
+    def _apply_remote_user(self, local_session: Session, row: dict):
+        """Пользователь из Supabase → локальная база"""
+        self.id_map.remember("company", row["company_supabase_id"], remote_id=row["company_id"])
+        return self._apply_remote(local_session, "user", row, {
+            "user_name": row["user_name"],
+            "email": row["email"],
+            "password": row["password"],
+            "phone": row["phone"],
+            "telegram": row["telegram"],
+            "status": row["status"],
+            "company_id": self.id_map.local_id("company", row["company_supabase_id"]),
+            "is_deleted": row["is_deleted"],
+        })
+
+    def _apply_remote_task(self, local_session: Session, row: dict):
+        """Задача из Supabase → локальная база"""
+        self.id_map.remember("company", row["company_supabase_id"], remote_id=row["company_id"])
+        self.id_map.remember("user", row["assignee_supabase_id"], remote_id=row["assignee_id"])
+        values = {
+            "title": row["title"],
+            "description": row["description"],
+            "assignee_id": self.id_map.local_id("user", row["assignee_supabase_id"]),
+            "company_id": self.id_map.local_id("company", row["company_supabase_id"]),
+            "due_date": row["due_date"],
+            "priority": row["priority"],
+            "status": row["status"],
+            "is_deleted": row["is_deleted"],
+        }
+
+        archived = local_session.exec(select(TaskArchive).where(TaskArchive.supabase_id == row["supabase_id"])).first()
+        if archived:
+            if self.archiver.is_archivable(row):
+                # Задача остается в архиве: обновляем архивную копию без истории
+                if row["version"] == archived.version:
+                    return None, archived.id
+                for field, value in values.items():
+                    if value is not None or row.get(field) is None:
+                        setattr(archived, field, value)
+                archived.version = row["version"]
+                archived.updated_at = row["updated_at"]
+                archived.edited_at = row.get("edited_at")
+                return "UPDATE", archived.id
+            # Задачу снова взяли в работу — возвращаем из архива и сливаем как обычно
+            self.archiver.restore(local_session, archived.id, touch=False)
+
+        return self._apply_remote(local_session, "task", row, values)
+
+    def _apply_remote(self, local_session: Session, table_name: str, row: dict, values: dict):
+        """Добавляем новую запись или сливаем изменения существующей; возвращает (действие, local id)"""
+        model = PULL_MODELS[table_name]
+        action = None
+        local_record = local_session.exec(select(model).where(model.supabase_id == row["supabase_id"])).first()
+
+        if not local_record:
+            unresolved = self._unresolved_references(row, values)
+            if unresolved:
+                # Связанной записи нет локально (например, она вне области репликации): запись откладывается
+                raise LookupError(f"unresolved references: {', '.join(unresolved)}")
+            local_record = model(
+                **values,
+                supabase_id=row["supabase_id"],
+                is_synced=True,
+                version=row["version"],
+                created_at=row["created_at"],
+                updated_at=row["updated_at"],
+                edited_at=row.get("edited_at")
+            )
+            local_session.add(local_record)
+            local_session.flush()
+            action = "CREATE"
+        elif row["version"] != local_record.version:
+            # Версия не изменилась — запись пропускаем без сравнения полей
+            action = self._merge_remote(local_session, table_name, local_record, row, values)
+
+        self.id_map.remember(table_name, row["supabase_id"], local_record.id, row["id"])
+        return action, local_record.id
+
+    def _merge_remote(self, local_session: Session, table_name: str, local_record, row: dict, values: dict):
+        """Слияние изменений из Supabase по полям
+
+        Поля, измененные только в Supabase, применяются сразу. Поле, измененное локально (есть
+        в outbox), конфликтует, только если в Supabase оно тоже изменилось — отличается от значения,
+        от которого начата локальная правка (base_values в outbox). Иначе остается локальное значение.
+        При конфликте побеждает более поздняя правка (last writer wins): время правки в Supabase
+        (edited_at) сравнивается с временем локальной правки из outbox — оба по часам клиентов
+        в момент правки. Обновляются только изменившиеся поля, изменения задач пишутся в TaskHistory.
+        """
+        entries = self._pending_entries(local_session, table_name, local_record.id)
+        pending, bases, local_edited_at = self._pending_fields(entries)
+        # Записи, отправленные до появления edited_at, сравниваем по времени Supabase, как раньше
+        remote_edited_at = row.get("edited_at") or row["updated_at"]
+        remote_is_newer = local_edited_at is None or remote_edited_at >= local_edited_at
+        changes = []
+        rebased = {}
+
+        for field, remote_value in values.items():
+            if remote_value is None and row.get(field) is not None:
+                # Связанная запись еще не получена из Supabase
+                continue
+            local_value = getattr(local_record, field)
+            conflict = False
+            if ALL_FIELDS in pending or field in pending:
+                # Локальная правка теперь считается сделанной поверх значения из Supabase
+                rebased[field] = base_value(remote_value)
+                # Без известного значения до правки (старые записи outbox) считаем поле измененным и в Supabase
+                conflict = field not in bases or bases[field] != base_value(remote_value)
+                if not conflict or not remote_is_newer:
+                    continue
+            if remote_value == local_value:
+                continue
+            setattr(local_record, field, remote_value)
+            changes.append((field, local_value, remote_value, conflict))
+
+        # Локальные изменения теперь основаны на этой версии и будут отправлены поверх нее
+        local_record.version = row["version"]
+        self._rebase_entries(entries, rebased)
+        if local_record.edited_at is None or remote_edited_at > local_record.edited_at:
+            local_record.edited_at = remote_edited_at
+        if not pending:
+            local_record.updated_at = row["updated_at"]
+            local_record.is_synced = True
+
+        if table_name == "task":
+            for field, old_value, new_value, conflict in changes:
+                local_session.add(TaskHistory(
+                    task_id=local_record.id,
+                    field_name=field,
+                    old_value=base_value(old_value),
+                    new_value=base_value(new_value),
+                    changed_by="sync:conflict" if conflict else "sync",
+                ))
+
+        return "UPDATE" if changes else None
+
+    def _pending_entries(self, local_session: Session, table_name: str, record_id: int) -> list:
+        """Записи outbox, еще не отправленные в Supabase, в порядке правок"""
+        return local_session.exec(
+            select(SyncOutbox)
+            .where(SyncOutbox.table_name == table_name)
+            .where(SyncOutbox.record_id == record_id)
+            .order_by(SyncOutbox.id)
+        ).all()
+
+    @staticmethod
+    def _pending_fields(entries):
+        """Поля, измененные локально, их значения до первой правки и время последней правки"""
+        pending, bases = set(), {}
+        edited_at = max((entry.created_at for entry in entries), default=None)
+        for entry in entries:
+            if entry.action != "UPDATE" or entry.changed_fields is None:
+                return {ALL_FIELDS}, {}, edited_at
+            pending.update(field for field in entry.changed_fields.split(",") if field)
+            for field, value in json.loads(entry.base_values or "{}").items():
+                # Значение до правки — из самой ранней записи: следующие правки сделаны поверх предыдущих
+                bases.setdefault(field, value)
+        return pending, bases, edited_at
+
+    @staticmethod
+    def _rebase_entries(entries, rebased: dict):
+        """Значения до правки в outbox после слияния — значения из Supabase"""
+        for entry in entries:
+            if entry.action != "UPDATE" or entry.changed_fields is None:
+                continue
+            fields = set(entry.changed_fields.split(",")) & rebased.keys()
+            if fields:
+                bases = json.loads(entry.base_values or "{}")
+                bases.update((field, rebased[field]) for field in fields)
+                entry.base_values = json.dumps(bases)
+
+    def _drain_outbox(self, local_session: Session, remote_session: Session, model, table_name: str,
+                      references: dict, to_remote):
+        """Отправляем изменения таблицы из outbox в Supabase по порядку, пачками
+
+        references — внешние ключи записи ({таблица: поле}), remote id для них
+        подгружаются в id_map одним запросом на пачку
+        """
+        with self.metrics.phase(f"push.{table_name}"):
+            try:
+                after_id = 0
+                while True:
+                    entries = local_session.exec(
+                        select(SyncOutbox)
+                        .where(SyncOutbox.table_name == table_name)
+                        .where(SyncOutbox.id > after_id)
+                        .where(SyncOutbox.attempts < SYNC_PUSH_MAX_ATTEMPTS)
+                        .order_by(SyncOutbox.id)
+                        .limit(SYNC_PUSH_BATCH_SIZE)
+                    ).all()
+                    if not entries:
+                        return
+
+                    # Изменения с конфликтом версий остаются в outbox, поэтому идем по id, а не с начала очереди
+                    after_id = entries[-1].id
+                    print(f"📤 Syncing {len(entries)} {table_name} changes to Supabase...")
+                    if not self._push_batch(local_session, remote_session, model, table_name, entries, references, to_remote):
+                        # Supabase недоступен: порядок важен, повторим с этого места в следующем цикле
+                        return
+            finally:
+                # Лог синхронизации всегда пишется в основную базу
+                self.sync_log.flush(db_manager.get_writer())
+
+    def _push_batch(self, local_session: Session, remote_session: Session, model, table_name: str, entries,
+                    references: dict, to_remote) -> bool:
+        """Отправка пачки outbox; False — ошибка соединения, отправку таблицы нужно прервать
+
+        Если пачка не прошла из-за данных, записи отправляются по одной: ошибочная запись
+        получает попытку и текст ошибки, остальные уходят в Supabase
+        """
+        error = self._push_changes(local_session, remote_session, model, table_name, entries, references, to_remote)
+        if error is None:
+            return True
+        if isinstance(error, CONNECTION_ERRORS):
+            return False
+        if len(entries) == 1:
+            self._record_failure(local_session, entries[0].id, error)
+            return True
+        print(f"    ↩️ Retrying {len(entries)} {table_name} changes one by one")
+        return all(
+            self._push_batch(local_session, remote_session, model, table_name, [entry], references, to_remote)
+            for entry in entries
+        )
+
+    def _record_failure(self, local_session: Session, entry_id: int, error: Exception):
+        """Неудачная попытка отправки записи outbox; после SYNC_PUSH_MAX_ATTEMPTS запись откладывается"""
+        outbox = SyncOutbox.__table__
+        # Текст ошибки драйвера, без SQL и параметров пачки
+        error = getattr(error, "orig", None) or error
+        attempts = db_manager.get_writer(local_session.get_bind()).run(
+            lambda session: session.execute(
+                update(outbox)
+                .where(outbox.c.id == entry_id)
+                .values(attempts=outbox.c.attempts + 1, last_error=str(error)[:1000])
+                .returning(outbox.c.attempts)
+            ).scalar(),
+            skip_outbox=True
+        )
+        local_session.expire_all()
+        if attempts is not None and attempts >= SYNC_PUSH_MAX_ATTEMPTS:
+            print(f"    ⏸️ Outbox entry {entry_id} failed {attempts} times, parking it: {error}")
+
+    def _push_changes(self, local_session: Session, remote_session: Session, model, table_name: str, entries,
+                      references: dict, to_remote):
+        """Одна пачка outbox: один upsert в Supabase и одна локальная транзакция. Возвращает ошибку или None
+
+        Запись в Supabase обновляется, только если ее версия совпадает с версией, от которой
+        начаты локальные изменения. Иначе запись изменили в Supabase — изменения остаются
+        в outbox и отправляются после слияния при получении изменений (_merge_remote)
+        """
+        # Данные пачки читаем сразу: после коммита записи outbox уже удалены
+        changes = [(entry.id, entry.record_id, entry.action, entry.supabase_id) for entry in entries]
+        entry_ids = [entry_id for entry_id, _, _, _ in changes]
+        record_ids = {record_id for _, record_id, action, _ in changes if action != "DELETE"}
+        created_ids = {record_id for _, record_id, action, _ in changes if action == "CREATE"}
+        deleted = [(record_id, supabase_id) for _, record_id, action, supabase_id in changes if action == "DELETE"]
+        # Удаление уходит в Supabase со временем правки из outbox
+        deleted_values = [
+            {"b_supabase_id": entry.supabase_id, "b_edited_at": entry.created_at}
+            for entry in entries if entry.action == "DELETE" and entry.supabase_id
+        ]
+        rows = local_session.exec(select(model).where(model.id.in_(record_ids))).all() if record_ids else []
+        held = self._out_of_scope(table_name, rows)
+        if held:
+            # Изменения компаний вне области остаются в outbox
+            print(f"    ⚠️ {len(held)} {table_name} changes are outside the replication scope, keeping them in outbox")
+            rows = [row for row in rows if row.id not in held]
+            record_ids -= held
+
         try:
-            with Session(db_manager.local_engine) as session:
-                sync_log = SyncLog(
-                    action=action,
-                    table_name=table_name,
-                    record_id=record_id,
-                    supabase_id=supabase_id,
-                    sync_timestamp=datetime.utcnow()
+            for ref_table, field in references.items():
+                self.id_map.prefetch_remote_ids(remote_session, ref_table, {getattr(row, field) for row in rows})
+
+            values = [{**to_remote(row), "version": row.version + 1} for row in rows]
+            accepted = {}
+            if values:
+                upsert = self._upsert(remote_session, model, values).returning(model.id, model.supabase_id, model.version)
+                accepted = {
+                    supabase_id: (remote_id, version)
+                    for remote_id, supabase_id, version in remote_session.execute(upsert).all()
+                }
+
+            if deleted_values:
+                soft_delete = (
+                    update(model.__table__)
+                    .where(model.__table__.c.supabase_id == bindparam("b_supabase_id"))
+                    .values(
+                        is_deleted=True,
+                        version=model.__table__.c.version + 1,
+                        updated_at=self._remote_now(remote_session),
+                        edited_at=bindparam("b_edited_at")
+                    )
+                )
+                guard = self.scope.guard(model.__table__)
+                if guard is not None:
+                    soft_delete = soft_delete.where(guard)
+                remote_session.execute(soft_delete, deleted_values)
+            remote_session.commit()
+        except Exception as e:
+            print(f"❌ Error pushing {len(entry_ids)} {table_name} changes: {e}")
+            self._cycle_errors += 1
+            remote_session.rollback()
+            return e
+
+        pushed = []
+        for row, value in zip(rows, values):
+            if value["supabase_id"] not in accepted:
+                continue
+            remote_id, version = accepted[value["supabase_id"]]
+            pushed.append({"b_id": row.id, "b_supabase_id": value["supabase_id"], "b_version": version})
+            self.id_map.remember(table_name, value["supabase_id"], row.id, remote_id)
+        pushed_ids = {change["b_id"] for change in pushed}
+
+        conflicts = record_ids - pushed_ids
+        self.metrics.add("rows_pushed", len(pushed_ids) + len(deleted), table_name)
+        if conflicts:
+            self.metrics.add("conflicts", len(conflicts), table_name)
+            print(f"    ⚠️ {len(conflicts)} {table_name} changes conflict with newer Supabase versions, merging on pull")
+
+        done_ids = [
+            entry_id for entry_id, record_id, action, _ in changes
+            if action == "DELETE" or (record_id not in conflicts and record_id not in held)
+        ]
+        table = model.__table__
+        # supabase_id, version и is_synced видны в списках API: меняется и ETag компании
+        pushed_companies = {row.id if table_name == "company" else row.company_id for row in rows if row.id in pushed_ids}
+
+        def write(session: Session):
+            bump(session, pushed_companies)
+            if pushed:
+                session.execute(
+                    update(table)
+                    .where(table.c.id == bindparam("b_id"))
+                    .values(version=bindparam("b_version")),
+                    pushed
+                )
+            # Отправленные изменения удаляем из outbox в той же транзакции
+            session.execute(delete(SyncOutbox.__table__).where(SyncOutbox.__table__.c.id.in_(done_ids)))
+            if pushed_ids:
+                # Отложенные записи тех же строк устарели: строка отправлена в Supabase целиком
+                session.execute(
+                    delete(SyncOutbox.__table__)
+                    .where(SyncOutbox.table_name == table_name)
+                    .where(SyncOutbox.record_id.in_(pushed_ids))
+                    .where(SyncOutbox.attempts >= SYNC_PUSH_MAX_ATTEMPTS)
+                )
+
+            # Синхронизированными считаем только записи без более новых изменений в outbox
+            if pushed_ids:
+                newer_changes = (
+                    select(SyncOutbox.id)
+                    .where(SyncOutbox.table_name == table_name)
+                    .where(SyncOutbox.record_id == table.c.id)
+                )
+                session.execute(
+                    update(table)
+                    .where(table.c.id.in_(pushed_ids))
+                    .where(~exists(newer_changes))
+                    .values(is_synced=True)
+                )
+
+        db_manager.get_writer(local_session.get_bind()).run(write, skip_outbox=True)
+        # Следующая пачка читается заново, без устаревших версий из identity map
+        local_session.expire_all()
+        # Соответствия id хранятся в основной базе (local_session может быть файлом компании)
+        if self.id_map.has_changes:
+            db_manager.get_writer().run(self.id_map.flush, skip_outbox=True)
+
+        for change in pushed:
+            record_id = change["b_id"]
+            self.sync_log.add("CREATE" if record_id in created_ids else "UPDATE", table_name, record_id, change["b_supabase_id"])
+        for record_id, supabase_id in deleted:
+            self.sync_log.add("DELETE", table_name, record_id, supabase_id)
+        return None
+
+    def _backfill_outbox(self):
+        """Записи, измененные до появления outbox, ставим в очередь один раз"""
+        def backfill(local_session: Session, tables: dict):
+            for model, table_name in tables.items():
+                queued = (
+                    select(SyncOutbox.id)
+                    .where(SyncOutbox.table_name == table_name)
+                    .where(SyncOutbox.record_id == model.id)
                 )
-                session.add(sync_log)
-                session.commit()
+                unsynced = (
+                    select(
+                        literal(table_name),
+                        model.id,
+                        case((model.version == 0, "CREATE"), else_="UPDATE"),
+                        model.supabase_id,
+                        func.coalesce(model.edited_at, model.updated_at),
+                    )
+                    .where(model.is_synced == False)
+                    .where(~exists(queued))
+                    .order_by(model.id)
+                )
+                local_session.execute(insert(SyncOutbox.__table__).from_select(
+                    ["table_name", "record_id", "action", "supabase_id", "created_at"], unsynced
+                ))
+
+        try:
+            for engine in db_manager.task_engines():
+                # В файлах компаний хранятся только задачи
+                tables = OUTBOX_TABLES if engine is db_manager.local_engine else {Task: "task"}
+                db_manager.get_writer(engine).run(lambda local_session: backfill(local_session, tables), skip_outbox=True)
+            self._outbox_backfilled = True
         except Exception as e:
-            print(f"❌ Error logging sync: {e}")
+            print(f"❌ Outbox backfill error: {e}")
+            self._cycle_errors += 1
+
+    def _upsert(self, remote_session: Session, model, values: list):
+        """INSERT ... ON CONFLICT (supabase_id) DO UPDATE для пачки записей"""
+        if remote_session.get_bind().dialect.name == "postgresql":
+            from sqlalchemy.dialects.postgresql import insert
+        else:
+            from sqlalchemy.dialects.sqlite import insert
+
+        now = self._remote_now(remote_session)
+        stmt = insert(model.__table__).values([{**value, "updated_at": now} for value in values])
+        update_columns = {
+            key: stmt.excluded[key] for key in values[0]
+            if key not in ("supabase_id", "created_at")
+        }
+        update_columns["updated_at"] = stmt.excluded.updated_at
+        # Обновляем только ту версию, от которой начаты локальные изменения
+        where = model.__table__.c.version + 1 == stmt.excluded.version
+        guard = self.scope.guard(model.__table__)
+        if guard is not None:
+            # Записи компаний вне области узел не перезаписывает
+            where = where & guard
+        return stmt.on_conflict_do_update(
+            index_elements=[model.__table__.c.supabase_id],
+            set_=update_columns,
+            where=where
+        )
+
+    def _out_of_scope(self, table_name: str, rows) -> set:
+        """id локальных записей, относящихся к компаниям вне области репликации"""
+        if not self.scope.enabled:
+            return set()
+        held = set()
+        for row in rows:
+            if table_name == "company":
+                # Новая компания (еще не отправлялась в Supabase) отправляется всегда
+                if row.version == 0:
+                    continue
+                supabase_id = row.supabase_id
+            else:
+                supabase_id = self.id_map.supabase_by_local.get(("company", row.company_id))
+            if not self.scope.allows(supabase_id):
+                held.add(row.id)
+        return held
+
+    def _remote_company_id(self, local_company_id):
+        """Находим id соответствующей компании в Supabase"""
+        if not local_company_id:
+            return None
+        remote_id = self.id_map.remote_id("company", local_company_id)
+        if remote_id is None:
+            print(f"    ⚠️ No remote company found for local company {local_company_id}")
+        return remote_id
+
+    def _remote_user_id(self, local_user_id):
+        """Находим id соответствующего пользователя в Supabase"""
+        if not local_user_id:
+            return None
+        remote_id = self.id_map.remote_id("user", local_user_id)
+        if remote_id is None:
+            print(f"    ⚠️ No remote user found for local user {local_user_id}")
+        return remote_id
+
+    def _apply_page(self, table_name: str, apply_row, cursor, page: list) -> int:
+        """Применяем страницу; возвращает количество примененных изменений
+
+        Задачи в режиме шардов применяются заданиями потоков записи файлов своих компаний.
+        Остальные записи, курсор и id_map фиксируются одним заданием потока записи основной
+        базы, после коммита файлов компаний. Записи, которые не удалось применить, откладываются
+        (SyncPullFailure) в той же транзакции, а курсор сдвигается за них: одна такая запись
+        не останавливает выгрузку таблицы и зависящих от нее таблиц. cursor=None — повтор
+        отложенных записей, курсор не меняется
+        """
+        groups = {} # Движок файла -> записи
+        for row in page:
+            groups.setdefault(self._row_engine(table_name, row), []).append(row)
+
+        processed = 0
+        failed = [] # (запись, ошибка)
+        for engine, rows in groups.items():
+            if engine is db_manager.local_engine:
+                continue
+            count, errors = db_manager.get_writer(engine).run(
+                lambda local_session: self._apply_rows(local_session, table_name, apply_row, rows),
+                skip_outbox=True
+            )
+            processed += count
+            failed += errors
+
+        def apply_local(local_session: Session):
+            count, errors = self._apply_rows(local_session, table_name, apply_row, groups.get(db_manager.local_engine, []))
+            self._park_rows(local_session, table_name, page, failed + errors)
+            if cursor is not None:
+                self._save_cursor(local_session, cursor, page[-1])
+            self.id_map.flush(local_session)
+            return count, errors
+
+        count, errors = db_manager.get_writer().run(apply_local, skip_outbox=True)
+        failed += errors
+
+        parked = self._parked.setdefault(table_name, {})
+        if cursor is not None:
+            # Ошибкой цикла считается только новая отложенная запись, повторы — нет
+            self._cycle_errors += sum(1 for row, _ in failed if row["supabase_id"] not in parked)
+            self._retry_ids.get(table_name, set()).difference_update(row["supabase_id"] for row in page)
+        failed_ids = {row["supabase_id"] for row, _ in failed}
+        for row in page:
+            if row["supabase_id"] in failed_ids:
+                parked[row["supabase_id"]] = parked.get(row["supabase_id"], 0) + 1
+            else:
+                parked.pop(row["supabase_id"], None)
+        return processed + count
+
+    def _park_rows(self, local_session: Session, table_name: str, page: list, failed: list):
+        """Отложенные записи страницы: неудачные получают попытку и текст ошибки, примененные снимаются с учета"""
+        table = SyncPullFailure.__table__
+        parked = self._parked.get(table_name, {})
+        failed_ids = {row["supabase_id"] for row, _ in failed}
+        resolved = [row["supabase_id"] for row in page if row["supabase_id"] in parked and row["supabase_id"] not in failed_ids]
+        if resolved:
+            local_session.execute(
+                delete(table).where(table.c.table_name == table_name).where(table.c.supabase_id.in_(resolved))
+            )
+        if failed:
+            now = datetime.utcnow()
+            stmt = sqlite_insert(table).values([
+                {
+                    "table_name": table_name,
+                    "supabase_id": row["supabase_id"],
+                    "attempts": 1,
+                    # Текст ошибки драйвера, без SQL и параметров
+                    "last_error": str(getattr(error, "orig", None) or error)[:1000],
+                    "failed_at": now,
+                }
+                for row, error in failed
+            ])
+            local_session.execute(stmt.on_conflict_do_update(
+                index_elements=[table.c.table_name, table.c.supabase_id],
+                set_={"attempts": table.c.attempts + 1, "last_error": stmt.excluded.last_error,
+                      "failed_at": stmt.excluded.failed_at}
+            ))
+
+    def _apply_rows(self, local_session: Session, table_name: str, apply_row, rows: list):
+        """Записи страницы в задании потока записи файла
+
+        Возвращает (применено изменений, [(запись, ошибка)] для записей, которые не удалось применить)
+        """
+        processed = 0
+        failed = []
+        for row in rows:
+            try:
+                # Точка сохранения на запись: ошибка одной записи не отменяет остальные
+                with local_session.begin_nested():
+                    action, local_id = apply_row(local_session, row)
+            except Exception as e:
+                print(f"    ❌ Error processing remote {table_name} {row['id']}, parking it: {e}")
+                failed.append((row, e))
+                continue
+            if action:
+                # Записи из окна перед курсором обычно не изменились и не считаются
+                self.sync_log.add(action, table_name, local_id, row["supabase_id"])
+                processed += 1
+        return processed, failed
+
+    def _row_engine(self, table_name: str, row: dict):
+        """Файл, в который применяется запись: задачи в режиме шардов — файл своей компании"""
+        if table_name != "task" or not LOCAL_SHARDING:
+            return db_manager.local_engine
+        return db_manager.company_engine(self.id_map.local_id("company", row["company_supabase_id"]))
+
+    def _get_cursor(self, local_session: Session, table_name: str) -> SyncCursor:
+        """Курсор последней успешной выгрузки таблицы из Supabase"""
+        cursor = local_session.get(SyncCursor, table_name)
+        if not cursor:
+            cursor = SyncCursor(table_name=table_name)
+        return cursor
+
+    def _pull_query(self, table_name: str):
+        """Запрос записей таблицы Supabase в области репликации
+
+        Вместе с записью выбираются supabase_id связанных компании и пользователя,
+        чтобы перевести внешние ключи без отдельных запросов
+        """
+        model = PULL_MODELS[table_name]
+        table = model.__table__
+        company = Company.__table__.alias("fk_company")
+        query = select(table)
+
+        if table_name == "user":
+            query = query.add_columns(company.c.supabase_id.label("company_supabase_id")) \
+                .outerjoin(company, table.c.company_id == company.c.id)
+        elif table_name == "task":
+            assignee = User.__table__.alias("fk_user")
+            query = query.add_columns(
+                company.c.supabase_id.label("company_supabase_id"),
+                assignee.c.supabase_id.label("assignee_supabase_id"),
+            ).outerjoin(company, table.c.company_id == company.c.id) \
+                .outerjoin(assignee, table.c.assignee_id == assignee.c.id)
+
+        guard = self.scope.guard(table)
+        if guard is not None:
+            # Только компании области репликации — фильтр выполняется в Supabase
+            query = query.where(guard)
+        return query
+
+    def _changed_since(self, table_name: str, position):
+        """Запрос удаленных записей, измененных после позиции (updated_at, id, settled_at)
+
+        Записи из окна SYNC_PULL_OVERLAP_SECONDS перед позицией выбираются повторно, пока
+        settled_at не пройдет курсор: уже примененные пропускаются по версии
+        """
+        table = PULL_MODELS[table_name].__table__
+        query = self._pull_query(table_name)
+        last_updated_at, last_remote_id, settled_at = position
+        reread_from = self._reread_from(last_updated_at, settled_at)
+        if reread_from is not None:
+            query = query.where(table.c.updated_at >= reread_from)
+        elif last_updated_at is not None:
+            query = query.where(
+                (table.c.updated_at > last_updated_at) |
+                ((table.c.updated_at == last_updated_at) & (table.c.id > last_remote_id))
+            )
+        elif table_name == "task":
+            # Первая загрузка: удаленные задачи локально не нужны
+            query = query.where(table.c.is_deleted == False)
+        return query.order_by(table.c.updated_at, table.c.id)
+
+    @staticmethod
+    def _reread_from(last_updated_at, settled_at):
+        """Начало окна, перечитываемого перед курсором, или None, если записи до курсора уже получены"""
+        overlap = timedelta(seconds=SYNC_PULL_OVERLAP_SECONDS)
+        if last_updated_at is None or not overlap or last_updated_at - datetime.min <= overlap:
+            return None
+        if settled_at is not None and settled_at > last_updated_at:
+            return None
+        reread_from = last_updated_at - overlap
+        if settled_at is not None and settled_at > reread_from:
+            reread_from = settled_at
+        return reread_from
+
+    def _settle_cursor(self, cursor: SyncCursor, pulled_at):
+        """После полной выгрузки: записи старше ее начала на окно получены и больше не перечитываются
+
+        Курсор сохраняется, только пока окно перед ним еще перечитывается — в простое записей нет
+        """
+        if pulled_at is None or self._reread_from(cursor.last_updated_at, cursor.settled_at) is None:
+            return
+        settled_at = pulled_at - timedelta(seconds=SYNC_PULL_OVERLAP_SECONDS)
+        if cursor.settled_at is not None and settled_at <= cursor.settled_at:
+            return
+        cursor.settled_at = settled_at
+
+        def write(local_session: Session):
+            local_session.add(cursor)
+        db_manager.get_writer().run(write, skip_outbox=True)
+
+    def _remote_time(self):
+        """Текущее время Supabase или None, если его не удалось получить"""
+        remote_session = db_manager.get_remote_session()
+        if not remote_session:
+            return None
+        try:
+            return remote_session.execute(select(self._remote_now(remote_session))).scalar()
+        except Exception as e:
+            print(f"⚠️ Could not read Supabase time, keeping the re-read window: {e}")
+            return None
+        finally:
+            remote_session.close()
+
+    def _save_cursor(self, local_session: Session, cursor: SyncCursor, last_pulled):
+        """Сдвигаем курсор на последнюю успешно обработанную запись (коммит — у потока записи)"""
+        if last_pulled is None:
+            return
+        if cursor.last_updated_at is not None and \
+                (last_pulled["updated_at"], last_pulled["id"]) <= (cursor.last_updated_at, cursor.last_remote_id):
+            # Запись из окна перед курсором: курсор назад не сдвигается
+            return
+        cursor.last_updated_at = last_pulled["updated_at"]
+        cursor.last_remote_id = last_pulled["id"]
+        cursor.scope = self.scope.key()
+        local_session.add(cursor)
+
+    def _remote_now(self, remote_session: Session):
+        """Время сервера Supabase (UTC), чтобы курсоры не зависели от часов клиентов"""
+        if remote_session.get_bind().dialect.name == "postgresql":
+            return func.timezone("UTC", func.now())
+        return func.current_timestamp()
+
 
 sync_service = SimpleSyncService()
\ No newline at end of file
@@ -0,0 +1,118 @@
+import csv
+import gzip
+import os
+from datetime import datetime, date
+from enum import Enum
+from sqlalchemy import Enum as SAEnum, select
+
+# Первая загрузка нового узла: snapshot — снимком, incremental — обычной выгрузкой изменений
+SYNC_BOOTSTRAP = os.getenv("SYNC_BOOTSTRAP", "snapshot")
+# Сколько строк снимка вставляется одним executemany
+SYNC_SNAPSHOT_BATCH_SIZE = int(os.getenv("SYNC_SNAPSHOT_BATCH_SIZE", "1000"))
+# statement_timeout выгрузки снимка (мс, 0 — без ограничения): COPY большой компании по медленной
+# сети идет дольше обычного statement_timeout движка Supabase
+SYNC_SNAPSHOT_STATEMENT_TIMEOUT = int(os.getenv("SYNC_SNAPSHOT_STATEMENT_TIMEOUT", "0"))
+
+# NULL в CSV снимка (пустая строка — это пустая строка)
+NULL = r"\N"
+
+
+def _format(value) -> str:
+    # Значения в том же виде, в каком их выдает COPY ... TO STDOUT (FORMAT csv)
+    if value is None:
+        return NULL
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    if isinstance(value, Enum):
+        return value.name
+    if isinstance(value, datetime):
+        return value.isoformat(" ")
+    return str(value)
+
+
+def _parser(column):
+    """Разбор текстового значения колонки снимка"""
+    if column is None:
+        return str
+    if isinstance(column.type, SAEnum) and column.type.enum_class:
+        return lambda value: column.type.enum_class[value]
+    try:
+        python_type = column.type.python_type
+    except NotImplementedError:
+        return str
+    if python_type is bool:
+        return lambda value: value in ("t", "true", "1")
+    if python_type is datetime:
+        return datetime.fromisoformat
+    if python_type is date:
+        return date.fromisoformat
+    if python_type in (int, float):
+        return python_type
+    return str
+
+
+def export_snapshot(remote_engine, directory: str, queries: dict) -> tuple:
+    """Выгружаем снимок таблиц в сжатые CSV-файлы одной согласованной транзакцией
+
+    queries — {таблица: (запрос строк, таблица модели)}. В Postgres строки идут через
+    COPY ... TO STDOUT прямо в gzip-файл, без построчного разбора на стороне клиента.
+    Вместе со снимком запоминается позиция (updated_at, id) каждой таблицы — с нее
+    продолжается инкрементальная выгрузка. Возвращает ({таблица: путь}, {таблица: позиция})
+    """
+    paths, positions = {}, {}
+    postgres = remote_engine.dialect.name == "postgresql"
+    options = {"isolation_level": "REPEATABLE READ", "postgresql_readonly": True} if postgres else {}
+    with remote_engine.connect().execution_options(**options) as connection:
+        with connection.begin():
+            if postgres:
+                # Только для этой транзакции: остальные запросы движка сохраняют свой таймаут
+                connection.exec_driver_sql(f"SET LOCAL statement_timeout = {SYNC_SNAPSHOT_STATEMENT_TIMEOUT}")
+            for table_name, (query, table) in queries.items():
+                last = connection.execute(
+                    select(table.c.updated_at, table.c.id)
+                    .order_by(table.c.updated_at.desc(), table.c.id.desc())
+                    .limit(1)
+                ).first()
+                positions[table_name] = (last[0], last[1]) if last else (None, 0)
+
+                path = os.path.join(directory, f"{table_name}.csv.gz")
+                with gzip.open(path, "wt", compresslevel=1, newline="") as snapshot_file:
+                    if postgres:
+                        sql = query.compile(dialect=connection.dialect, compile_kwargs={"literal_binds": True})
+                        cursor = connection.connection.dbapi_connection.cursor()
+                        try:
+                            cursor.copy_expert(
+                                f"COPY ({sql}) TO STDOUT WITH (FORMAT csv, HEADER true, NULL '{NULL}')",
+                                snapshot_file
+                            )
+                        finally:
+                            cursor.close()
+                    else:
+                        result = connection.execution_options(stream_results=True).execute(query)
+                        writer = csv.writer(snapshot_file)
+                        writer.writerow(result.keys())
+                        for row in result:
+                            writer.writerow([_format(value) for value in row])
+                paths[table_name] = path
+    return paths, positions
+
+
+def read_snapshot(path: str, table, batch_size: int = SYNC_SNAPSHOT_BATCH_SIZE):
+    """Читаем файл снимка пачками словарей с типизированными значениями"""
+    with gzip.open(path, "rt", newline="") as snapshot_file:
+        reader = csv.reader(snapshot_file)
+        header = next(reader, None)
+        if header is None:
+            return
+        parsers = [_parser(table.c.get(name)) for name in header]
+        batch = []
+        for values in reader:
+            batch.append({
+                name: None if value == NULL else parse(value)
+                for name, parse, value in zip(header, parsers, values)
+            })
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
@@ -0,0 +1,109 @@
+import os
+from datetime import datetime, timedelta
+from sqlmodel import Session
+from sqlalchemy import insert, delete, select, func, exists, literal
+from models import Task, TaskArchive, TaskStatus, SyncOutbox
+from company_revision import bump
+from change_feed import record_changes
+
+# Через сколько дней после последнего изменения выполненные и удаленные задачи уходят в архив
+ARCHIVE_AFTER_DAYS = int(os.getenv("TASK_ARCHIVE_AFTER_DAYS", "30"))
+# Как часто проверять задачи для архивации (часы)
+ARCHIVE_INTERVAL_HOURS = float(os.getenv("TASK_ARCHIVE_INTERVAL_HOURS", "6"))
+# Сколько задач переносится за одну транзакцию
+ARCHIVE_BATCH_SIZE = int(os.getenv("TASK_ARCHIVE_BATCH_SIZE", "500"))
+
+# Общие колонки задачи и архива
+TASK_COLUMNS = [column.name for column in Task.__table__.columns]
+
+
+class TaskArchiver:
+    """Перенос выполненных и удаленных задач в архивную таблицу и обратно"""
+
+    def __init__(self):
+        self._last_run = None
+
+    @staticmethod
+    def cutoff() -> datetime:
+        return datetime.utcnow() - timedelta(days=ARCHIVE_AFTER_DAYS)
+
+    def is_archivable(self, row: dict) -> bool:
+        """Задача из Supabase сразу относится к архиву"""
+        return (row["is_deleted"] or row["status"] == TaskStatus.DONE) and row["updated_at"] < self.cutoff()
+
+    def is_due(self) -> bool:
+        """Пора ли проверять задачи (раз в ARCHIVE_INTERVAL_HOURS)"""
+        now = datetime.utcnow()
+        if self._last_run and now - self._last_run < timedelta(hours=ARCHIVE_INTERVAL_HOURS):
+            return False
+        self._last_run = now
+        return True
+
+    def archive(self, writer):
+        """Переносим старые выполненные и удаленные задачи базы в архив (пачками через поток записи)
+
+        Задачи с неотправленными изменениями не трогаем. Задачу с максимальным id тоже оставляем:
+        SQLite выдает новый id как max(id) + 1, и id архивной задачи не должен достаться новой
+        """
+        now = datetime.utcnow()
+        task = Task.__table__
+        pending = select(SyncOutbox.id) \
+            .where(SyncOutbox.table_name == "task") \
+            .where(SyncOutbox.record_id == task.c.id)
+        candidates = (
+            select(task.c.id)
+            .where(task.c.is_deleted | (task.c.status == TaskStatus.DONE))
+            .where(task.c.updated_at < self.cutoff())
+            .where(task.c.is_synced == True)
+            .where(~exists(pending))
+            .where(task.c.id < select(func.max(task.c.id)).scalar_subquery())
+            .limit(ARCHIVE_BATCH_SIZE)
+        )
+
+        def archive_batch(local_session: Session) -> int:
+            ids = local_session.execute(candidates).scalars().all()
+            if ids:
+                # Задачи уходят из списков компаний: меняется ETag, в ленте изменений — удаление
+                moved = local_session.execute(select(task.c.id, task.c.company_id).where(task.c.id.in_(ids))).all()
+                bump(local_session, {company_id for _, company_id in moved})
+                record_changes(local_session, "task", moved)
+                local_session.execute(insert(TaskArchive.__table__).from_select(
+                    TASK_COLUMNS + ["archived_at"],
+                    select(*[task.c[name] for name in TASK_COLUMNS], literal(now)).where(task.c.id.in_(ids))
+                ))
+                local_session.execute(delete(task).where(task.c.id.in_(ids)))
+            return len(ids)
+
+        archived = 0
+        try:
+            while True:
+                moved = writer.run(archive_batch, skip_outbox=True)
+                archived += moved
+                if moved < ARCHIVE_BATCH_SIZE:
+                    break
+        except Exception as e:
+            print(f"❌ Error archiving tasks: {e}")
+        if archived:
+            print(f"🗄️ Archived {archived} tasks older than {ARCHIVE_AFTER_DAYS} days")
+
+    def restore(self, local_session: Session, task_id: int, touch: bool = True):
+        """Возвращаем задачу из архива в рабочую таблицу (коммит — у вызывающего)
+
+        touch — отметить задачу как измененную сейчас, чтобы она не ушла в архив при следующей проверке.
+        Отметка локальная: в outbox изменение не попадает. Возвращает id задачи или None
+        """
+        archived = local_session.get(TaskArchive, task_id)
+        if not archived:
+            return None
+
+        values = {name: getattr(archived, name) for name in TASK_COLUMNS}
+        if touch:
+            values["updated_at"] = datetime.utcnow()
+        if local_session.get(Task, task_id):
+            # id уже занят новой задачей — задача получит новый id
+            values.pop("id")
+        new_id = local_session.execute(insert(Task.__table__).values(**values)).inserted_primary_key[0]
+        record_changes(local_session, "task", [(new_id, archived.company_id)])
+        local_session.delete(archived)
+        local_session.flush()
+        return new_id
@@ -0,0 +1,64 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+from sqlmodel import Session, create_engine, select
+import database
+import sync_service
+from migrations import migrate
+
+
+class Node:
+    """Узел с собственной локальной базой, синхронизирующийся с общей базой вместо Supabase"""
+
+    def __init__(self, directory: str, remote_engine, monkeypatch):
+        monkeypatch.setattr(database, "LOCAL_DB_PATH", os.path.join(directory, "task_manager.db"))
+        self.db = database.SafeDatabaseManager()
+        self.db.init_databases()
+        self.db.remote_engine = remote_engine
+        self.db.is_online = self.db.remote_schema_ready = self.db.remote_checked = True
+        self.service = sync_service.SimpleSyncService()
+        self._monkeypatch = monkeypatch
+
+    def sync(self) -> bool:
+        self._monkeypatch.setattr(sync_service, "db_manager", self.db)
+        return self.service.sync_data()
+
+    def write(self, fn):
+        """Локальная правка через поток записи (попадает в outbox)"""
+        return self.db.get_writer().run(fn)
+
+    def get(self, model, supabase_id: str):
+        with Session(self.db.local_engine) as session:
+            return session.exec(select(model).where(model.supabase_id == supabase_id)).one()
+
+    def close(self):
+        self.service.shutdown()
+        self.db.local_engine.dispose()
+
+
+@pytest.fixture
+def remote_engine(tmp_path):
+    """Общая база SQLite вместо Supabase"""
+    engine = create_engine(f"sqlite:///{tmp_path / 'remote.db'}", connect_args={"check_same_thread": False})
+    migrate(engine, remote=True)
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture
+def make_node(tmp_path, remote_engine, monkeypatch):
+    nodes = []
+
+    def make(name: str) -> Node:
+        directory = tmp_path / name
+        directory.mkdir()
+        node = Node(str(directory), remote_engine, monkeypatch)
+        nodes.append(node)
+        return node
+
+    yield make
+    for node in nodes:
+        node.close()
@@ -0,0 +1,33 @@
+import asyncio
+from datetime import datetime, timedelta
+from sqlmodel.ext.asyncio.session import AsyncSession
+import database
+from models import TaskArchive
+from pagination import fetch_page
+
+
+def test_archive_pages_by_archived_at(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, "LOCAL_DB_PATH", str(tmp_path / "task_manager.db"))
+    db = database.SafeDatabaseManager()
+    db.init_databases()
+    start = datetime(2026, 1, 1)
+    db.get_writer().run(lambda session: session.add_all([
+        TaskArchive(id=index + 1, title=f"T{index}", company_id=1 if index != 2 else 2,
+                    archived_at=start + timedelta(days=index % 3))
+        for index in range(7)
+    ]))
+
+    async def pages():
+        ids, cursor = [], None
+        async with AsyncSession(db.local_async_engine) as session:
+            while True:
+                page = await fetch_page(session, TaskArchive, TaskArchive.company_id == 1, 2, cursor, "id",
+                                        default_sort="-archived_at")
+                ids.append([item["id"] for item in page["items"]])
+                cursor = page["next_cursor"]
+                if cursor is None:
+                    break
+        await db.local_async_engine.dispose()
+        return ids
+
+    assert asyncio.run(pages()) == [[6, 5], [2, 7], [4, 1]]
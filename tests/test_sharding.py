@@ -0,0 +1,76 @@
+import os
+import pytest
+from sqlmodel import Session, create_engine, select, func
+import database
+from migrations import migrate
+from models import Company, Task, TaskHistory
+
+
+@pytest.fixture
+def seeded(tmp_path, monkeypatch):
+    """Основная база с задачами компании, созданная без шардирования"""
+    monkeypatch.setattr(database, "LOCAL_DB_PATH", str(tmp_path / "task_manager.db"))
+    monkeypatch.setattr(database, "LOCAL_SHARD_DIR", str(tmp_path / "shards"))
+    db = database.SafeDatabaseManager()
+    db.init_databases()
+
+    def write(session):
+        company = Company(title="Acme")
+        session.add(company)
+        session.flush()
+        tasks = [Task(title=f"T{index}", company_id=company.id) for index in range(3)]
+        session.add_all(tasks)
+        session.flush()
+        session.add_all([TaskHistory(task_id=task.id, field_name="title", new_value=task.title) for task in tasks])
+        return company.id
+    company_id = db.get_writer().run(write)
+    db.local_engine.dispose()
+    monkeypatch.setattr(database, "LOCAL_SHARDING", True)
+    return company_id
+
+
+def _count(engine, model, **filters) -> int:
+    with Session(engine) as session:
+        query = select(func.count()).select_from(model)
+        for field, value in filters.items():
+            query = query.where(getattr(model, field) == value)
+        return session.exec(query).one()
+
+
+def test_interrupted_move_is_repeated_on_startup(seeded, tmp_path):
+    # Прерванный перенос: задача 1 уже скопирована в файл компании, но не удалена из основной базы
+    os.makedirs(database.LOCAL_SHARD_DIR)
+    shard = create_engine(f"sqlite:///{tmp_path / 'shards' / f'company_{seeded}.db'}")
+    migrate(shard)
+    with Session(shard) as session:
+        session.add(Task(id=1, title="T0", company_id=seeded))
+        session.add(TaskHistory(task_id=1, field_name="title", new_value="T0"))
+        session.commit()
+    shard.dispose()
+
+    db = database.SafeDatabaseManager()
+    db.init_databases()
+
+    engine = db.company_engine(seeded)
+    assert engine is not db.local_engine
+    assert _count(db.local_engine, Task) == 0
+    assert _count(db.local_engine, TaskHistory) == 0
+    assert _count(engine, Task, company_id=seeded) == 3
+    assert _count(engine, TaskHistory) == 3
+    assert len(db.task_engines()) == 2
+
+
+def test_failed_move_keeps_company_in_main_database(seeded, monkeypatch):
+    def fail(self, company_id):
+        raise RuntimeError("disk full")
+    monkeypatch.setattr(database.SafeDatabaseManager, "_move_company_tasks", fail)
+    os.makedirs(database.LOCAL_SHARD_DIR)
+    # Файл компании от прежней неудачной попытки не подключается
+    open(os.path.join(database.LOCAL_SHARD_DIR, f"company_{seeded}.db"), "w").close()
+
+    db = database.SafeDatabaseManager()
+    db.init_databases()
+
+    assert db.company_engine(seeded) is db.local_engine
+    assert db.task_engines() == [db.local_engine]
+    assert _count(db.local_engine, Task, company_id=seeded) == 3
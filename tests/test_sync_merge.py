@@ -0,0 +1,65 @@
+from sqlmodel import Session, select
+from models import Company, Task, TaskHistory, TaskStatus
+
+
+def _create_task(node) -> str:
+    def write(session):
+        company = Company(title="Acme")
+        session.add(company)
+        session.flush()
+        task = Task(title="T1", company_id=company.id)
+        session.add(task)
+        session.flush()
+        return task.supabase_id
+    return node.write(write)
+
+
+def _edit_task(node, supabase_id: str, **fields):
+    def write(session):
+        task = session.exec(select(Task).where(Task.supabase_id == supabase_id)).one()
+        for field, value in fields.items():
+            setattr(task, field, value)
+    node.write(write)
+
+
+def _remote_task(remote_engine, supabase_id: str) -> Task:
+    with Session(remote_engine) as session:
+        return session.exec(select(Task).where(Task.supabase_id == supabase_id)).one()
+
+
+def test_remote_edit_of_another_field_keeps_local_edit(make_node, remote_engine):
+    node_a, node_b = make_node("a"), make_node("b")
+    task_id = _create_task(node_a)
+    assert node_a.sync()
+    assert node_b.sync()
+
+    _edit_task(node_a, task_id, status=TaskStatus.DONE)
+    _edit_task(node_b, task_id, title="T1 renamed")
+    assert node_b.sync()
+    node_a.sync() # Отправка статуса конфликтует по версии, слияние — при получении
+    node_a.sync()
+    assert node_b.sync()
+
+    for task in (node_a.get(Task, task_id), node_b.get(Task, task_id), _remote_task(remote_engine, task_id)):
+        assert (task.title, task.status) == ("T1 renamed", TaskStatus.DONE)
+    with Session(node_a.db.local_engine) as session:
+        assert session.exec(select(TaskHistory).where(TaskHistory.changed_by == "sync:conflict")).all() == []
+
+
+def test_concurrent_edit_of_same_field_goes_to_later_edit(make_node, remote_engine):
+    node_a, node_b = make_node("a"), make_node("b")
+    task_id = _create_task(node_a)
+    assert node_a.sync()
+    assert node_b.sync()
+
+    _edit_task(node_a, task_id, status=TaskStatus.DONE)
+    _edit_task(node_b, task_id, status=TaskStatus.IN_PROGRESS)
+    assert node_b.sync()
+    node_a.sync()
+    node_a.sync()
+
+    assert node_a.get(Task, task_id).status == TaskStatus.IN_PROGRESS
+    assert _remote_task(remote_engine, task_id).status == TaskStatus.IN_PROGRESS
+    with Session(node_a.db.local_engine) as session:
+        history = session.exec(select(TaskHistory).where(TaskHistory.changed_by == "sync:conflict")).all()
+    assert [(entry.field_name, entry.new_value) for entry in history] == [("status", TaskStatus.IN_PROGRESS.value)]
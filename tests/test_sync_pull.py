@@ -0,0 +1,74 @@
+import time
+import pytest
+from sqlmodel import Session, select
+import sync_service
+from models import Company, Task, User, SyncPullFailure
+from sync_metrics import sync_metrics
+from sync_scope import ReplicationScope
+
+
+def _bytes_received() -> int:
+    return sync_metrics.snapshot()["last_cycle"]["bytes_received"]
+
+
+def test_idle_pull_stops_rereading_overlap_window(make_node, monkeypatch):
+    monkeypatch.setattr(sync_service, "SYNC_PULL_OVERLAP_SECONDS", 1)
+    node = make_node("a")
+
+    def write(session):
+        company = Company(title="Acme")
+        session.add(company)
+        session.flush()
+        session.add_all([Task(title=f"T{index}", company_id=company.id) for index in range(20)])
+    node.write(write)
+    assert node.sync()
+    assert _bytes_received() > 0
+
+    # Окно перед курсором перечитывается, пока выгрузка не начнется позже него больше чем на окно
+    time.sleep(2.1)
+    assert node.sync()
+    assert node.sync()
+    assert _bytes_received() == 0
+
+
+@pytest.mark.parametrize("bootstrap", ["incremental", "snapshot"])
+def test_unresolvable_row_is_parked_and_later_rows_arrive(make_node, monkeypatch, bootstrap):
+    monkeypatch.setattr(sync_service, "SYNC_BOOTSTRAP", bootstrap)
+    node_a, node_b = make_node("a"), make_node("b")
+
+    def write(session):
+        inside, outside = Company(title="Inside"), Company(title="Outside")
+        session.add_all([inside, outside])
+        session.flush()
+        user = User(user_name="Bob", email="bob@example.com", password="secret", company_id=outside.id)
+        session.add(user)
+        session.flush()
+        # Исполнитель из компании вне области репликации узла B
+        task = Task(title="T1", company_id=inside.id, assignee_id=user.id)
+        session.add(task)
+        session.flush()
+        return inside.id, inside.supabase_id, task.supabase_id
+    company_id, company_supabase_id, parked_id = node_a.write(write)
+    assert node_a.sync()
+
+    node_b.service.scope = ReplicationScope({company_supabase_id})
+    assert not node_b.sync()
+
+    def add_task(session):
+        task = Task(title="T2", company_id=company_id)
+        session.add(task)
+        session.flush()
+        return task.supabase_id
+    task_id = node_a.write(add_task)
+    assert node_a.sync()
+
+    # Повторная попытка отложенной записи не считается ошибкой цикла
+    assert node_b.sync()
+    assert node_b.get(Task, task_id).title == "T2"
+    with Session(node_b.db.local_engine) as session:
+        failures = session.exec(select(SyncPullFailure)).all()
+    assert [failure.supabase_id for failure in failures] == [parked_id]
+    assert failures[0].attempts > 1
+    with Session(node_b.db.local_engine) as session:
+        assert session.exec(select(Task.supabase_id).where(Task.assignee_id == None)).all() == [task_id]
+    assert node_b.service.get_backlog()["parked_pulls"] == 1
@@ -0,0 +1,20 @@
+from sqlmodel import Session, select
+from models import Company, SyncOutbox
+
+
+def test_push_waits_for_remote_schema(make_node, remote_engine):
+    node = make_node("a")
+    node.write(lambda session: session.add(Company(title="Acme")))
+    node.db.remote_schema_ready = False
+    node.sync()
+
+    with Session(node.db.local_engine) as session:
+        entries = session.exec(select(SyncOutbox)).all()
+    assert [(entry.table_name, entry.attempts) for entry in entries] == [("company", 0)]
+    with Session(remote_engine) as session:
+        assert session.exec(select(Company)).all() == []
+
+    node.db.remote_schema_ready = True
+    assert node.sync()
+    with Session(remote_engine) as session:
+        assert [company.title for company in session.exec(select(Company))] == ["Acme"]